@@ -4,29 +4,993 @@ abadge - generate badges/shields with pure HTML/CSS.
 
 
 """
-from copy import deepcopy
-
-label_css = '''
-    background: #444;
-    border-radius: 4px 0px 0px 4px;
-    color: white;
-    font-family: DejaVu Sans,Verdana,sans;
-    font-size: 80%;
-    padding: 4px 8px 4px 8px;
-    text-shadow: 1px 1px black
-}'''
-
-value_css = '''
-.badge-value {
-    background: #2b2;
-    border-radius: 0px 4px 4px 0px;
-    color: white;
-    font-family: DejaVu Sans,Verdana,sans;
-    font-size: 80%;
-    padding: 4px 8px 4px 8px;
-    text-shadow: 1px 1px black
+# Only modules which are cheap to import are imported here, since abadge is
+# often used in short-lived processes. The optional parts (the server, the
+# command line, NumPy, the glob patterns) import what they need on first use.
+from _thread import allocate_lock as Lock
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from itertools import repeat
+from operator import itemgetter
+from weakref import WeakValueDictionary, ref
+
+# Style declarations of the label and value parts, used both for the inline
+# styles in Badge.template and for the rules in Badge.stylesheet()
+label_css = 'background:{label_background};' \
+            'border-radius:{border_radius} 0px 0px {border_radius};' \
+            'color:{label_text_color};' \
+            'font-family:{font_family};' \
+            'font-size:{font_size};' \
+            'padding:{padding};' \
+            'text-shadow:{label_text_shadow};'
+
+value_css = 'background:{value_background};' \
+            'border-radius:0px {border_radius} {border_radius} 0px;' \
+            'color:{value_text_color};' \
+            'font-family:{font_family};' \
+            'font-size:{font_size};' \
+            'padding:{padding};' \
+            'text-shadow:{value_text_shadow};'
+
+# CSS named colors, for shading
+_css_colors = {
+    'aliceblue': '#f0f8ff', 'antiquewhite': '#faebd7', 'aqua': '#00ffff',
+    'aquamarine': '#7fffd4', 'azure': '#f0ffff', 'beige': '#f5f5dc',
+    'bisque': '#ffe4c4', 'black': '#000000', 'blanchedalmond': '#ffebcd',
+    'blue': '#0000ff', 'blueviolet': '#8a2be2', 'brown': '#a52a2a',
+    'burlywood': '#deb887', 'cadetblue': '#5f9ea0', 'chartreuse': '#7fff00',
+    'chocolate': '#d2691e', 'coral': '#ff7f50', 'cornflowerblue': '#6495ed',
+    'cornsilk': '#fff8dc', 'crimson': '#dc143c', 'cyan': '#00ffff',
+    'darkblue': '#00008b', 'darkcyan': '#008b8b', 'darkgoldenrod': '#b8860b',
+    'darkgray': '#a9a9a9', 'darkgreen': '#006400', 'darkgrey': '#a9a9a9',
+    'darkkhaki': '#bdb76b', 'darkmagenta': '#8b008b',
+    'darkolivegreen': '#556b2f', 'darkorange': '#ff8c00',
+    'darkorchid': '#9932cc', 'darkred': '#8b0000', 'darksalmon': '#e9967a',
+    'darkseagreen': '#8fbc8f', 'darkslateblue': '#483d8b',
+    'darkslategray': '#2f4f4f', 'darkslategrey': '#2f4f4f',
+    'darkturquoise': '#00ced1', 'darkviolet': '#9400d3', 'deeppink': '#ff1493',
+    'deepskyblue': '#00bfff', 'dimgray': '#696969', 'dimgrey': '#696969',
+    'dodgerblue': '#1e90ff', 'firebrick': '#b22222', 'floralwhite': '#fffaf0',
+    'forestgreen': '#228b22', 'fuchsia': '#ff00ff', 'gainsboro': '#dcdcdc',
+    'ghostwhite': '#f8f8ff', 'gold': '#ffd700', 'goldenrod': '#daa520',
+    'gray': '#808080', 'green': '#008000', 'greenyellow': '#adff2f',
+    'grey': '#808080', 'honeydew': '#f0fff0', 'hotpink': '#ff69b4',
+    'indianred': '#cd5c5c', 'indigo': '#4b0082', 'ivory': '#fffff0',
+    'khaki': '#f0e68c', 'lavender': '#e6e6fa', 'lavenderblush': '#fff0f5',
+    'lawngreen': '#7cfc00', 'lemonchiffon': '#fffacd', 'lightblue': '#add8e6',
+    'lightcoral': '#f08080', 'lightcyan': '#e0ffff',
+    'lightgoldenrodyellow': '#fafad2', 'lightgray': '#d3d3d3',
+    'lightgreen': '#90ee90', 'lightgrey': '#d3d3d3', 'lightpink': '#ffb6c1',
+    'lightsalmon': '#ffa07a', 'lightseagreen': '#20b2aa',
+    'lightskyblue': '#87cefa', 'lightslategray': '#778899',
+    'lightslategrey': '#778899', 'lightsteelblue': '#b0c4de',
+    'lightyellow': '#ffffe0', 'lime': '#00ff00', 'limegreen': '#32cd32',
+    'linen': '#faf0e6', 'magenta': '#ff00ff', 'maroon': '#800000',
+    'mediumaquamarine': '#66cdaa', 'mediumblue': '#0000cd',
+    'mediumorchid': '#ba55d3', 'mediumpurple': '#9370db',
+    'mediumseagreen': '#3cb371', 'mediumslateblue': '#7b68ee',
+    'mediumspringgreen': '#00fa9a', 'mediumturquoise': '#48d1cc',
+    'mediumvioletred': '#c71585', 'midnightblue': '#191970',
+    'mintcream': '#f5fffa', 'mistyrose': '#ffe4e1', 'moccasin': '#ffe4b5',
+    'navajowhite': '#ffdead', 'navy': '#000080', 'oldlace': '#fdf5e6',
+    'olive': '#808000', 'olivedrab': '#6b8e23', 'orange': '#ffa500',
+    'orangered': '#ff4500', 'orchid': '#da70d6', 'palegoldenrod': '#eee8aa',
+    'palegreen': '#98fb98', 'paleturquoise': '#afeeee',
+    'palevioletred': '#db7093', 'papayawhip': '#ffefd5',
+    'peachpuff': '#ffdab9', 'peru': '#cd853f', 'pink': '#ffc0cb',
+    'plum': '#dda0dd', 'powderblue': '#b0e0e6', 'purple': '#800080',
+    'rebeccapurple': '#663399', 'red': '#ff0000', 'rosybrown': '#bc8f8f',
+    'royalblue': '#4169e1', 'saddlebrown': '#8b4513', 'salmon': '#fa8072',
+    'sandybrown': '#f4a460', 'seagreen': '#2e8b57', 'seashell': '#fff5ee',
+    'sienna': '#a0522d', 'silver': '#c0c0c0', 'skyblue': '#87ceeb',
+    'slateblue': '#6a5acd', 'slategray': '#708090', 'slategrey': '#708090',
+    'snow': '#fffafa', 'springgreen': '#00ff7f', 'steelblue': '#4682b4',
+    'tan': '#d2b48c', 'teal': '#008080', 'thistle': '#d8bfd8',
+    'tomato': '#ff6347', 'turquoise': '#40e0d0', 'violet': '#ee82ee',
+    'wheat': '#f5deb3', 'white': '#ffffff', 'whitesmoke': '#f5f5f5',
+    'yellow': '#ffff00', 'yellowgreen': '#9acd32', 'transparent': '#00000000',
 }
-'''
+
+# Advance widths of the printable ASCII characters in DejaVu Sans, in 1/2048
+# em, and the ascent and descent of the font. Used to estimate the size of the
+# text in SVG badges, also for other fonts since the text can not be measured.
+_dejavu_widths = (
+    651, 821, 942, 1716, 1303, 1946, 1597, 563, 799, 799, 1024, 1716, 651, 739,
+    651, 690, 1303, 1303, 1303, 1303, 1303, 1303, 1303, 1303, 1303, 1303, 690,
+    690, 1716, 1716, 1716, 1087, 2048, 1401, 1405, 1430, 1577, 1294, 1178,
+    1587, 1540, 604, 604, 1343, 1141, 1767, 1532, 1612, 1235, 1612, 1423, 1300,
+    1251, 1499, 1401, 2025, 1403, 1251, 1403, 799, 690, 799, 1716, 1024, 1024,
+    1255, 1300, 1126, 1300, 1260, 721, 1300, 1298, 569, 569, 1186, 569, 1995,
+    1298, 1253, 1300, 1300, 842, 1067, 803, 1298, 1212, 1675, 1212, 1212, 1075,
+    1303, 690, 1303, 1716)
+_char_widths = dict((chr(32 + i), w / 2048.0)
+                    for i, w in enumerate(_dejavu_widths))
+_default_char_width = 1229 / 2048.0
+_font_ascent = 1901 / 2048.0
+_font_height = (1901 + 483) / 2048.0
+
+_MISSING = object()
+_hex_bytes = ['{:02x}'.format(i) for i in range(256)]
+_parsed_colors = {}
+_numpy = _MISSING
+
+
+class _FrozenDict(dict):
+    """
+    Read-only dict, used for snapshots of the nested configuration tables.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('the configuration tables are read-only, set a new'
+                        ' table instead')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+
+def _freeze(value):
+    """
+    Return a read-only deep copy of dicts and lists in value.
+    """
+    if isinstance(value, _FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return _FrozenDict((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class _ThresholdTable(_FrozenDict):
+    """
+    Frozen "thresholds" table, shared by all configurations with the same
+    content, together with the compiled thresholds of its labels.
+    """
+    __slots__ = ('compiled', 'patterns')
+
+    def __reduce__(self):
+        # Intern again when unpickled, keeping the compiled labels
+        return _intern_thresholds, (dict(self),), dict(self.compiled)
+
+    def __setstate__(self, compiled):
+        for label, threshold in compiled.items():
+            self.compiled.setdefault(label, threshold)
+
+
+# The interned threshold tables, by the repr of their content
+_threshold_tables = WeakValueDictionary()
+_threshold_tables_lock = Lock()
+
+
+def _intern_thresholds(thresholds):
+    """
+    Return the shared frozen table with the same content as thresholds.
+
+    Identical threshold configurations, given to many instances, are then
+    stored and compiled only once. The tables are looked up by their repr,
+    which tells 1, 1.0, True and "1" apart, and checked for equality before
+    they are shared.
+    :param thresholds: "thresholds" dict
+    :return: _ThresholdTable
+    """
+    if thresholds.__class__ is _ThresholdTable:
+        return thresholds
+    key = repr(thresholds)
+    with _threshold_tables_lock:
+        interned = _threshold_tables.get(key)
+    if interned is not None and interned == thresholds:
+        return interned
+    table = _ThresholdTable(_freeze(thresholds))
+    table.compiled = {}
+    table.patterns = None
+    with _threshold_tables_lock:
+        if _threshold_tables.get(key) is None:
+            _threshold_tables[key] = table
+    return table
+
+
+class _Config(dict):
+    """
+    Configuration of a Badge instance.
+
+    The "thresholds" and "value_backgrounds" tables are snapshotted into
+    read-only dicts when they are set, so that later changes to the dicts
+    given by the caller do not affect the badge, and so the tables can be
+    compiled once and shared by all renders without being copied.
+
+    The "thresholds" tables are also interned, so instances with the same
+    thresholds share one table and its compiled thresholds.
+
+    The version is increased on every change, so that state compiled from
+    the configuration can tell when it is outdated.
+    """
+    __slots__ = ('version',)
+    frozen_options = frozenset(['thresholds', 'value_backgrounds'])
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.version = 0
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),), self.version
+
+    def __setstate__(self, version):
+        # Keep the version, so that compiled state pickled along with the
+        # configuration is still valid
+        self.version = version
+
+    def copy(self):
+        """
+        Return a copy, without freezing the already frozen tables again.
+        """
+        config = _Config()
+        dict.update(config, self)
+        return config
+
+    def __setitem__(self, key, value):
+        if key == 'thresholds':
+            value = _intern_thresholds(value)
+        elif key in self.frozen_options:
+            value = _freeze(value)
+        dict.__setitem__(self, key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version += 1
+
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.version += 1
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class _Overlay(dict):
+    """
+    Per-call layer on top of a configuration, like a two-level ChainMap.
+
+    Only the options which are set in the layer are stored, all other keys
+    are read from the base configuration, so rendering does not need to copy
+    the instance configuration.
+    """
+    __slots__ = ('base',)
+
+    def __init__(self, base, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.base = base
+
+    def __missing__(self, key):
+        return self.base[key]
+
+
+def _import_numpy():
+    """
+    Return the numpy module, or None if it is not installed.
+    """
+    global _numpy
+    if _numpy is _MISSING:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def _escape_xml(text):
+    """
+    Escape text for use in XML text and attribute values.
+    """
+    return (str(text).replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def _css_pixels(length, font_size=16.0):
+    """
+    Convert a CSS length to pixels.
+    :param length: CSS length, like "4px", "80%" or "1.2em"
+    :param font_size: font size in pixels, which "em" and "%" are relative to
+    :return: float
+    """
+    length = str(length).strip()
+    for unit, factor in (('px', 1.0), ('pt', 4 / 3.0), ('rem', 16.0),
+                         ('em', font_size), ('%', font_size / 100.0)):
+        if length.endswith(unit):
+            return float(length[:-len(unit)]) * factor
+    return float(length)
+
+
+_font_size_keywords = {'xx-small': 9.0, 'x-small': 10.0, 'small': 13.0,
+                       'medium': 16.0, 'large': 18.0, 'x-large': 24.0,
+                       'xx-large': 32.0, 'smaller': 13.0, 'larger': 19.0}
+
+
+def _css_length(length, font_size, default):
+    """
+    Convert a CSS length to pixels like _css_pixels, but return the default
+    for keywords and units that are not known, like "small" or "1vw".
+    """
+    try:
+        return _css_pixels(length, font_size)
+    except ValueError:
+        return default
+
+
+@lru_cache(maxsize=256)
+def _svg_metrics(font_size, padding, border_radius):
+    """
+    Return the font size, padding and border radius in pixels.
+    :return: tuple with font size, top, right, bottom and left padding and
+             border radius
+    """
+    font_px = _css_length(font_size, 16.0,
+                          _font_size_keywords.get(str(font_size), 16.0))
+    sides = [_css_length(p, font_px, 0.0) for p in str(padding).split()]
+    # Expand the CSS shorthand: top [right [bottom [left]]]
+    while len(sides) < 4:
+        sides.append(sides[max(0, len(sides) - 2)] if sides else 0.0)
+    radius = _css_length((str(border_radius).split() or ['0'])[0], font_px,
+                         0.0)
+    return (font_px,) + tuple(sides) + (radius,)
+
+
+@lru_cache(maxsize=256)
+def _svg_shadow(text_shadow, font_px):
+    """
+    Return the offset and color of a CSS text-shadow, or None.
+    """
+    offsets = []
+    color = 'black'
+    for token in str(text_shadow).split():
+        try:
+            offsets.append(_css_pixels(token, font_px))
+        except ValueError:
+            color = token
+    if len(offsets) < 2 or text_shadow == 'none':
+        return None
+    return offsets[0], offsets[1], _escape_xml(color)
+
+
+def _text_width(text, font_px):
+    """
+    Estimate the width of the text in pixels.
+    """
+    return font_px * sum(map(_char_widths.get, text,
+                             repeat(_default_char_width, len(text))))
+
+
+_percents = ['{}%'.format(i) for i in range(101)]
+
+
+def _sparkline_heights(values):
+    """
+    Scale numbers to bar heights from 5 to 100 percent, so that the lowest
+    bar is still visible. NaN and infinite numbers get height 0.
+    :param values: sequence with numbers
+    :return: list with integer percents
+    """
+    from math import isfinite
+
+    numbers = [float(v) for v in values]
+    finite = [v for v in numbers if isfinite(v)]
+    if not finite:
+        return [0] * len(numbers)
+    low = min(finite)
+    high = max(finite)
+    if high == low:
+        return [100 if isfinite(v) else 0 for v in numbers]
+    scale = 95.0 / (high - low)
+    return [5 + int((v - low) * scale + 0.5) if isfinite(v) else 0
+            for v in numbers]
+
+
+def _chunks(rows, size):
+    """
+    Split rows into lists with size rows.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# The Badge and keyword arguments in a render_parallel worker process
+_worker = None
+
+
+def _init_worker(badge, kwargs):
+    global _worker
+    _worker = (badge, kwargs)
+
+
+def _render_chunk(rows):
+    badge, kwargs = _worker
+    return badge.render_many(rows, **kwargs), badge._css_rules
+
+
+def _is_glob(label):
+    return '*' in label or '?' in label or '[' in label
+
+
+class _LabelPatterns(object):
+    """
+    Index of the labels in a thresholds table which are glob patterns.
+
+    Patterns which end with "*" and have no other glob characters are
+    prefixes. They are kept in a trie, so the longest matching prefix is
+    found in one walk over the label. The other patterns are combined into
+    one regex, where the first matching pattern in definition order wins.
+    Prefixes take precedence over the other patterns, and "*" matches the
+    labels that no other pattern matches.
+    """
+    __slots__ = ('default', 'names', 'regex', 'trie')
+
+    def __init__(self, labels):
+        self.trie = {}
+        self.names = []
+        self.default = None
+        for label in labels:
+            if not isinstance(label, str) or not _is_glob(label):
+                continue
+            if label == '*':
+                self.default = label
+                continue
+            prefix = label[:-1]
+            if label[-1] == '*' and not _is_glob(prefix):
+                node = self.trie
+                for c in prefix:
+                    node = node.setdefault(c, {})
+                # None can not be a character, so it marks the end
+                node.setdefault(None, label)
+            else:
+                self.names.append(label)
+        self.regex = None
+        if self.names:
+            from fnmatch import translate
+            import re
+
+            self.regex = re.compile('|'.join(
+                '(?P<p{}>{})'.format(i, translate(name))
+                for i, name in enumerate(self.names)))
+
+    def match(self, label):
+        """
+        Return the pattern matching the label.
+        :param label: the badge label
+        :return: the pattern, or None if no pattern matches
+        """
+        if not isinstance(label, str):
+            return None
+        node = self.trie
+        found = None
+        for c in label:
+            node = node.get(c)
+            if node is None:
+                break
+            found = node.get(None, found)
+        if found is not None:
+            return found
+        if self.regex is not None:
+            match = self.regex.match(label)
+            if match:
+                return self.names[int(match.lastgroup[1:])]
+        return self.default
+
+
+class _Threshold(object):
+    """
+    Compiled threshold configuration for one label.
+
+    The keys in ``colors`` are cast and sorted once, so that finding the
+    color for a value is a bisect in a list instead of a sort and a linear
+    scan on every lookup. For shaded thresholds the colors are also parsed
+    into RGB tuples up front. With "shade_steps", each segment between two
+    thresholds gets a table with that many shades, so shading is an index
+    in the table.
+    """
+    __slots__ = ('above', 'caster', 'colors', 'gradients', 'keys', 'rgbs',
+                 'shade', 'steps', 'values')
+
+    def __init__(self, this):
+        self.colors = this['colors']
+        self.above = this.get('above', _MISSING)
+        self.shade = this.get('shade', None)
+        self.caster = None
+        order = this.get('order', 'auto')
+        if order != 'strict':
+            self.caster = Badge._get_caster_func(order, this)
+        self.keys = self.values = self.rgbs = self.gradients = None
+        self.steps = this.get('shade_steps', None)
+        if self.caster:
+            keys = sorted(list(self.colors.keys()), key=self.caster)
+            self.keys = [self.caster(k) for k in keys]
+            self.values = [self.colors[k] for k in keys]
+            if self.shade:
+                self.rgbs = []
+                for color in self.values:
+                    try:
+                        self.rgbs.append(Badge._parse_color(color))
+                    except ValueError:
+                        # Reported by _shade if the color is ever used
+                        self.rgbs.append(None)
+                # Tables are made when the segments are used
+                self.gradients = [None] * len(keys)
+
+    def lookup(self, value):
+        """
+        Return the color for the given value.
+
+        :param value: the badge value
+        :return: color string
+        :raises KeyError: if there is no color for the value
+        """
+        if not self.caster:
+            return self.colors[value]
+        value = self.caster(value)
+        keys = self.keys
+        index = bisect_left(keys, value)
+        # The extra comparison sends values which do not compare (NaN) to
+        # "above", as a linear scan would
+        if index == len(keys) or not value <= keys[index]:
+            if self.above is _MISSING:
+                raise KeyError('above')
+            return self.above
+        if self.shade:
+            last = index - 1 if index else 0
+            fraction = Badge._get_fraction(keys[last], keys[index], value)
+            rgb1 = self.rgbs[last]
+            rgb2 = self.rgbs[index]
+            if rgb1 is None or rgb2 is None:
+                return Badge._shade(fraction, self.values[last],
+                                    self.values[index])
+            if self.steps:
+                return self._gradient(index)[int(fraction * self.steps
+                                                 + 0.5)]
+            return Badge._shade_rgb(fraction, rgb1, rgb2)
+        return self.values[index]
+
+    def _gradient(self, index):
+        """
+        Return the table of shades for the segment below keys[index].
+        """
+        gradient = self.gradients[index]
+        if gradient is None:
+            rgb1 = self.rgbs[index - 1 if index else 0]
+            rgb2 = self.rgbs[index]
+            gradient = self.gradients[index] = [
+                Badge._shade_rgb(step / self.steps, rgb1, rgb2)
+                for step in range(self.steps + 1)]
+        return gradient
+
+    def _lookup_or_missing(self, value):
+        try:
+            return self.lookup(value)
+        except KeyError:
+            return _MISSING
+
+    def lookup_many(self, values, numpy=None):
+        """
+        Return the colors for many values.
+
+        With numpy, ordered numeric thresholds are resolved for all values
+        at once, with the same results as lookup.
+        :param values: list with badge values
+        :param numpy: the numpy module, or None to look up one at a time
+        :return: list with color strings, and _MISSING for the values
+                 which have no color
+        """
+        if (numpy is None or self.caster not in (int, float)
+                or (self.shade and None in self.rgbs)):
+            return [self._lookup_or_missing(value) for value in values]
+        dtype = numpy.int64 if self.caster is int else numpy.float64
+        try:
+            array = numpy.array([self.caster(v) for v in values], dtype=dtype)
+            keys = numpy.array(self.keys, dtype=dtype)
+        except OverflowError:
+            return [self._lookup_or_missing(value) for value in values]
+        if not len(array):
+            return []
+        if not len(keys):
+            return [self.above] * len(array)
+
+        # NaN is sorted last, so it also ends up "above"
+        index = numpy.searchsorted(keys, array, side='left')
+        above = index == len(keys)
+        index[above] = len(keys) - 1
+        if not self.shade:
+            colors = numpy.array(self.values, dtype=object)[index].tolist()
+        else:
+            last = numpy.maximum(index - 1, 0)
+            low = keys[last]
+            high = keys[index]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                fraction = numpy.where((high == low) | above, 0.0,
+                                       (array - low) / (high - low))
+            if self.steps:
+                steps = (fraction * self.steps + 0.5).astype(numpy.int64)
+                colors = [self._gradient(i)[step] for i, step
+                          in zip(index.tolist(), steps.tolist())]
+            else:
+                colors = self._shade_many(numpy, last, index, fraction)
+        if above.any():
+            for i in numpy.flatnonzero(above).tolist():
+                colors[i] = self.above
+        return colors
+
+    def _shade_many(self, numpy, last, index, fraction):
+        """
+        Vectorized Badge._shade_rgb for the segments between last and index.
+        """
+        alpha = numpy.array([len(rgb) == 4 for rgb in self.rgbs])
+        rgbs = numpy.array([tuple(rgb) + (255,) * (4 - len(rgb))
+                            for rgb in self.rgbs], dtype=numpy.int64)
+        rgb1 = rgbs[last]
+        rgb2 = rgbs[index]
+        shades = (rgb1 + (rgb2 - rgb1) * fraction[:, None]).astype(
+            numpy.int64)
+        # Pack each shade into one integer, with a flag above the 32 bits of
+        # RGBA for the shades with alpha, and format each distinct shade once
+        packed = numpy.where(
+            alpha[last] | alpha[index],
+            (1 << 32) | (shades[:, 0] << 24) | (shades[:, 1] << 16)
+            | (shades[:, 2] << 8) | shades[:, 3],
+            (shades[:, 0] << 16) | (shades[:, 1] << 8) | shades[:, 2])
+        unique, inverse = numpy.unique(packed, return_inverse=True)
+        colors = numpy.array(['#{:08x}'.format(p & 0xffffffff) if p >> 32
+                              else '#{:06x}'.format(p)
+                              for p in unique.tolist()], dtype=object)
+        return colors[inverse.reshape(-1)].tolist()
+
+
+_html_escapes = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                               '"': '&quot;', "'": '&#x27;'})
+
+
+@lru_cache(maxsize=4096)
+def _escape_html_string(value):
+    """
+    Escape a string for use in HTML text and attribute values.
+    """
+    escaped = value.translate(_html_escapes)
+    # Escaping always makes the text longer
+    return value if len(escaped) == len(value) else escaped
+
+
+def _escape_html(value):
+    """
+    Format value and escape it for use in HTML text and attribute values.
+
+    Numbers are never escaped, and strings without special characters are
+    returned as they are. The results for the most recently used strings are
+    kept, since the same labels and values are escaped over and over.
+    """
+    if value.__class__ is not str:
+        if value.__class__ in (int, float):
+            return format(value)
+        return format(value).translate(_html_escapes)
+    return _escape_html_string(value)
+
+
+class _Template(object):
+    """
+    Template in str.format syntax with some of the fields already filled in.
+
+    The template is split into literal chunks around the fields which are
+    left open, so rendering is a join instead of parsing the whole template
+    again.
+    """
+    __slots__ = ('convert', 'fields', 'getter', 'parts')
+
+    def __init__(self, template, conf, keep, escape=False):
+        """
+        :param template: template string in str.format syntax
+        :param conf: config dict with the values of the fields to fill in
+        :param keep: names of the fields to leave open
+        :param escape: HTML escape the values of the open fields
+        """
+        # Templates are compiled once per configuration, so the string module
+        # is only imported when the first badge is rendered
+        from string import Formatter
+
+        formatter = Formatter()
+        self.convert = _escape_html if escape else format
+        parts = ['']
+        self.fields = []
+        for literal, field, spec, conversion in formatter.parse(template):
+            parts[-1] += literal
+            if field is None:
+                continue
+            if field in keep:
+                self.fields.append((field, conversion, spec))
+                parts += [None, '']
+            else:
+                parts[-1] += self._format(
+                    formatter.get_field(field, (), conf)[0], conversion, spec)
+        self.parts = parts
+        self.getter = None
+        if len(self.fields) > 1 and not any(c or s for _, c, s in self.fields):
+            self.getter = itemgetter(*[f[0] for f in self.fields])
+
+    @staticmethod
+    def _format(value, conversion, spec):
+        if conversion == 's':
+            value = str(value)
+        elif conversion == 'r':
+            value = repr(value)
+        elif conversion == 'a':
+            value = ascii(value)
+        elif conversion:
+            raise ValueError('Unknown conversion specifier {}'
+                             ''.format(conversion))
+        return format(value, spec)
+
+    def render(self, conf):
+        """
+        Fill in the open fields.
+        :param conf: dict with the values of the open fields
+        :return: rendered string
+        """
+        parts = self.parts[:]
+        if self.getter:
+            parts[1::2] = map(self.convert, self.getter(conf))
+        elif self.convert is format:
+            parts[1::2] = [self._format(conf[f], c, s)
+                           for f, c, s in self.fields]
+        else:
+            parts[1::2] = [_escape_html(self._format(conf[f], c, s))
+                           for f, c, s in self.fields]
+        return ''.join(parts)
+
+
+class _Templates(object):
+    """
+    The templates of a Badge, compiled for one configuration.
+    """
+    __slots__ = ('body', 'link', 'value_classes', 'value_style')
+
+    def __init__(self, body, link, value_style=None):
+        """
+        :param body: compiled template for the badge
+        :param link: compiled template for the link around the badge
+        :param value_style: compiled style declarations for the value part,
+                            if the badge uses CSS classes
+        """
+        self.body = body
+        self.link = link
+        self.value_style = value_style
+        self.value_classes = {}
+
+    def render(self, conf, badge):
+        """
+        Render the badge.
+        :param conf: config with the row fields
+        :param badge: the Badge, which keeps the CSS rules
+        :return: string with HTML
+        """
+        if self.value_style:
+            background = conf['value_background']
+            value_class = self.value_classes.get(background)
+            if value_class is None:
+                value_class = badge._add_css_rule(
+                    conf['css_class'], self.value_style.render(conf))
+                self.value_classes[background] = value_class
+            conf['value_class'] = value_class
+        if conf['url']:
+            return self.link.render(conf) + self.body.render(conf) + '</a>'
+        return self.body.render(conf)
+
+
+class BadgeSpec(object):
+    """
+    Immutable description of one badge, to be rendered by
+    Badge.render_spec.
+
+    Only the label, the value and the options which are given are stored,
+    so a spec is a lot smaller than a dict with the same options. Specs are
+    hashable, if the option values are, and can be used as keys. They are
+    equal if the label, the value and the options are equal and of the
+    same types, since 1, 1.0 and True are rendered differently.
+
+    Usage::
+
+        spec = BadgeSpec('coverage', 87, url='https://ci.example.com')
+        html = badge.render_spec(spec)
+    """
+    __slots__ = ('label', 'value', 'options', '_hash')
+
+    def __init__(self, label, value, **options):
+        """
+        :param label: text for the label part
+        :param value: text for the value part
+        :param options: same keyword arguments as Badge.to_html, except
+                        label and value
+        :raises TypeError: for unknown options
+        """
+        if options:
+            Badge._parse_args((), options)
+            if 'label' in options or 'value' in options:
+                raise TypeError('label and value are given as arguments')
+        setter = object.__setattr__
+        setter(self, 'label', label)
+        setter(self, 'value', value)
+        setter(self, 'options', tuple(sorted(options.items())))
+        setter(self, '_hash', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('BadgeSpec is immutable, use replace()')
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return _restore_spec, (self.label, self.value, self.options)
+
+    def _key(self):
+        return (self.label, self.label.__class__,
+                self.value, self.value.__class__,
+                tuple((k, v.__class__, v) for k, v in self.options))
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._key() != other._key()
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(self._key()))
+        return self._hash
+
+    def __repr__(self):
+        return 'BadgeSpec({})'.format(', '.join(
+            [repr(self.label), repr(self.value)]
+            + ['{}={!r}'.format(k, v) for k, v in self.options]))
+
+    def replace(self, **changes):
+        """
+        Return a new spec with some of the label, value or options changed.
+        """
+        options = dict(self.options)
+        options.update(changes)
+        return BadgeSpec(options.pop('label', self.label),
+                         options.pop('value', self.value), **options)
+
+    def to_kwargs(self):
+        """
+        :return: dict with the keyword arguments for Badge.to_html
+        """
+        kwargs = dict(self.options)
+        kwargs['label'] = self.label
+        kwargs['value'] = self.value
+        return kwargs
+
+
+def _restore_spec(label, value, options):
+    # Unpickle a BadgeSpec without validating the options again
+    spec = BadgeSpec.__new__(BadgeSpec)
+    setter = object.__setattr__
+    setter(spec, 'label', label)
+    setter(spec, 'value', value)
+    setter(spec, 'options', options)
+    setter(spec, '_hash', None)
+    return spec
+
+
+CacheInfo = namedtuple('CacheInfo',
+                       ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class _RenderCache(object):
+    """
+    Bounded LRU cache for Badge.to_html.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.clear()
+
+    def __reduce__(self):
+        # Locks can not be pickled, and the content is cheap to recreate
+        return self.__class__, (self.maxsize,)
+
+    def clear(self):
+        with self.lock:
+            self.data = OrderedDict()
+            self.templates = None
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self.data))
+
+    def render(self, badge, args, kwargs):
+        """
+        Return the HTML for the arguments from the cache, or render it.
+        :param badge: the Badge to render with
+        :param args: positional arguments to to_html
+        :param kwargs: keyword arguments to to_html
+        :return: string with HTML
+        """
+        if len(args) > 2:
+            return badge._to_html(args, kwargs)
+        options = ()
+        label = kwargs.get('label', _MISSING)
+        value = kwargs.get('value', _MISSING)
+        if len(args) > 0:
+            label = args[0]
+        if len(args) > 1:
+            value = args[1]
+        if kwargs:
+            options = tuple(sorted((k, v.__class__, v)
+                                   for k, v in kwargs.items()
+                                   if k != 'label' and k != 'value'))
+        # The types are part of the key, since 1, 1.0 and True are equal but
+        # are rendered differently
+        key = (label, label.__class__, value, value.__class__, options)
+        try:
+            hash(key)
+        except TypeError:
+            return badge._to_html(args, kwargs)
+        return self.get(badge, key, badge._to_html, args, kwargs)
+
+    def get(self, badge, key, render, *args):
+        """
+        Return the HTML for a key from the cache, or render and store it.
+        :param badge: the Badge to render with
+        :param key: hashable key
+        :param render: function rendering the HTML
+        :param args: arguments to render
+        :return: string with HTML
+        """
+        # New templates means that the configuration has changed
+        templates = badge._instance_templates()
+        with self.lock:
+            if templates is not self.templates:
+                self.data.clear()
+                self.templates = templates
+            html = self.data.get(key)
+            if html is not None:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        html = render(*args)
+        with self.lock:
+            if templates is self.templates:
+                self.data[key] = html
+                if len(self.data) > self.maxsize:
+                    self.data.popitem(last=False)
+                    self.evictions += 1
+        return html
 
 
 class Badge(object):
@@ -46,9 +1010,22 @@ class Badge(object):
         print(Badge().to_html(label='tests', value='4/8'))  # Same thing
         print(Badge.make_badge(tests, '4/8'))               # This too
 
+    An instance can be shared by any number of threads. The rendering
+    methods do not change the configuration, and the state compiled from
+    it (templates, thresholds, label patterns, shades) is immutable once it
+    is published, with a single assignment. Threads which need state that
+    is not compiled yet may compile it at the same time, and one of the
+    results is kept. Reads take no locks; only the optional render cache
+    uses a lock. The configuration can be changed while other threads
+    render, but renders running at the time may see a mix of the old and
+    the new options.
     """
-    default_config = {
+    # Read-only, so that it can be shared by all instances. Assign a new
+    # dict to change the defaults of a subclass.
+    default_config = _freeze({
         'border_radius': '4px',
+        'css_class': '',
+        'escape': False,
         'font_family': 'DejaVu Sans, Verdana, sans',
         'font_size': '80%',
         'label': '',
@@ -65,30 +1042,70 @@ class Badge(object):
         'value_backgrounds': {},
         'value_text_color': 'white',
         'value_text_shadow': '1px 1px black',
-    }
-
-    template = '<span style="' \
-               'background:{label_background};' \
-               'border-radius:{border_radius} 0px 0px {border_radius};' \
-               'color:{label_text_color};' \
-               'font-family:{font_family};' \
-               'font-size:{font_size};' \
-               'padding:{padding};' \
-               'text-shadow:{label_text_shadow};' \
-               '">{label}</span>' \
-               '<span style="' \
-               'background:{value_background};' \
-               'border-radius:0px {border_radius} {border_radius} 0px;' \
-               'color:{value_text_color};' \
-               'font-family:{font_family};' \
-               'font-size:{font_size};' \
-               'padding:{padding};' \
-               'text-shadow:{value_text_shadow};' \
-               '">{value}</span>'
+    })
+    option_names = frozenset(default_config)
+
+    label_style = label_css
+    value_style = value_css
+
+    template = '<span style="' + label_style + '">{label}</span>' \
+               '<span style="' + value_style + '">{value}</span>'
+
+    class_template = '<span class="{label_class}">{label}</span>' \
+                     '<span class="{value_class}">{value}</span>'
 
     href_template = '<a href="{url}"{link_target}' \
                     ' style="text-decoration:{link_decoration};">'
 
+    svg_template = '<svg xmlns="http://www.w3.org/2000/svg"' \
+                   ' xmlns:xlink="http://www.w3.org/1999/xlink"' \
+                   ' width="{width:.2f}" height="{height:.2f}" role="img"' \
+                   ' aria-label="{title}"><title>{title}</title>' \
+                   '{link_start}' \
+                   '<path fill="{label_background}" d="M{radius:.2f},0' \
+                   'H{label_width:.2f}V{height:.2f}H{radius:.2f}' \
+                   'A{radius:.2f},{radius:.2f} 0 0 1 0,{bottom:.2f}' \
+                   'V{radius:.2f}A{radius:.2f},{radius:.2f} 0 0 1' \
+                   ' {radius:.2f},0Z"/>' \
+                   '<path fill="{value_background}" d="M{label_width:.2f},0' \
+                   'H{right:.2f}A{radius:.2f},{radius:.2f} 0 0 1' \
+                   ' {width:.2f},{radius:.2f}V{bottom:.2f}' \
+                   'A{radius:.2f},{radius:.2f} 0 0 1 {right:.2f},' \
+                   '{height:.2f}H{label_width:.2f}Z"/>' \
+                   '<g font-family="{font_family}"' \
+                   ' font-size="{font_size:.2f}"' \
+                   ' text-anchor="middle">{texts}</g>' \
+                   '{link_end}</svg>'
+
+    svg_text_template = '<text x="{x:.2f}" y="{y:.2f}" fill="{color}">' \
+                        '{text}</text>'
+
+    svg_bar_template = '<rect x="{x:.2f}" y="{y:.2f}" width="{width:.2f}"' \
+                       ' height="{height:.2f}" fill="{color}"/>'
+
+    # The bars are flex items, so they are blocks with percent heights and
+    # line up at the bottom
+    sparkline_template = '<span style="display:inline-flex;gap:1px;' \
+                         'align-items:flex-end;height:1em;' \
+                         'vertical-align:bottom;">{bars}</span>'
+
+    # The instance used by make_badge, created on first use
+    _default_badge = None
+    _default_badge_lock = Lock()
+
+    # Fields which are filled in on every render. All other fields are
+    # compiled into the templates once per configuration.
+    row_fields = frozenset(['label', 'url', 'value', 'value_background',
+                            'value_class'])
+
+    # Number of templates kept for calls which override other options than
+    # the row_fields
+    override_templates_size = 64
+
+    # Instrumentation recording the rendering phases, see
+    # enable_instrumentation
+    instrumentation = None
+
     def __init__(self, *args, **kwargs):
         """
         Create a badge object with the given configuration.
@@ -103,6 +1120,10 @@ class Badge(object):
         Keyword arguments:
         border_radius -- how rounded the corners of the badge should be
                         (CSS "padding")
+        css_class -- render "class" attributes instead of inline styles,
+                     with class names starting with the given prefix. The
+                     rules are returned by stylesheet()
+        escape -- HTML escape the label, value and url
         font_family -- font to use in the badge (CSS "font-family")
         font_size -- size of the font (CSS "font-size")
         label -- the text in label part of the badge
@@ -125,31 +1146,162 @@ class Badge(object):
         value_text_color -- text color for the value part (CSS "text-color")
         value_text_shadow -- text shadow for the value part (CSS "text-shadow")
         """
-        self.config = deepcopy(self.default_config)
-        self.config.update(self._parse_args(args, kwargs))
+        self._compiled_templates = (None,)
+        self._override_templates = (None, None, None)
+        self._css_rules = {}
+        self._cache = None
+        self._watcher = None
+        self._config = self._defaults()
+        if kwargs:
+            self._config.update(self._parse_args(args, kwargs))
+        elif len(args) > 2:
+            self._parse_args(args, kwargs)
         if len(args) > 0:
-            self.config['label'] = args[0]
+            self._config['label'] = args[0]
         if len(args) > 1:
-            self.config['value'] = args[1]
+            self._config['value'] = args[1]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'default_config' in cls.__dict__ and \
+                'option_names' not in cls.__dict__:
+            cls.option_names = frozenset(cls.default_config)
 
     @classmethod
-    def _parse_args(cls, args, kwargs):
+    def _defaults(cls):
         """
-        Parse kwargs and return a dict.
-        :param kwargs: dict to parse
-        :return:
+        Return a new configuration with the default values.
+
+        The default configuration is validated and frozen once per class,
+        and then copied without checking the values again.
+        :return: _Config
         """
-        if len(args) > 2:
-            raise ValueError('a maximum of 2 optional argument may be given'
-                             ' ({} were given.)'.format(len(args)))
-        for k in kwargs.keys():
-            if k not in cls.default_config:
-                raise TypeError('unknown option {}'.format(k))
-        return kwargs
+        snapshot = cls.__dict__.get('_default_snapshot')
+        if snapshot is None or snapshot[0] is not cls.default_config:
+            snapshot = (cls.default_config, _Config(cls.default_config))
+            cls._default_snapshot = snapshot
+        return snapshot[1].copy()
+
+    def __getstate__(self):
+        # The watcher thread and the instrumentation stay with the original
+        # instance
+        state = self.__dict__.copy()
+        state['_watcher'] = None
+        state.pop('instrumentation', None)
+        return state
 
     @classmethod
-    def _determine_type(cls, values):
-        is_float = False
+    def from_config_file(cls, path, watch=False, interval=2.0, **kwargs):
+        """
+        Create a badge with the options in a configuration file.
+
+        The file is a JSON, TOML or YAML (if PyYAML is installed) dict with
+        options, like "thresholds", chosen by the file name extension
+        (default JSON).
+        :param path: path of the configuration file
+        :param watch: reload the file when it changes, see watch_config_file
+        :param interval: seconds between checks for changes
+        :param kwargs: options which override the options in the file
+        :return: Badge
+        """
+        badge = cls()
+        badge.reload_config_file(path, **kwargs)
+        if watch:
+            badge.watch_config_file(path, interval, **kwargs)
+        return badge
+
+    def reload_config_file(self, path, **kwargs):
+        """
+        Replace the configuration with the options in a configuration file.
+
+        The new configuration, its templates and its thresholds are compiled
+        before the configuration is replaced with one assignment, so renders
+        use either the old or the new configuration, and never wait for the
+        reload. The configuration is not changed if the file can not be
+        read or has invalid options.
+        :param path: path of the configuration file, see from_config_file
+        :param kwargs: options which override the options in the file
+        """
+        options = _load_config_file(path)
+        if not isinstance(options, dict):
+            raise ValueError('{}: Error: the configuration is not a dict'
+                             ''.format(path))
+        options.update(kwargs)
+        config = self._defaults()
+        config.update(self._parse_args((), options))
+        thresholds = config['thresholds']
+        for label in thresholds:
+            self._get_threshold(thresholds, label)
+        templates = self._instance_templates(config)
+        self._config = config
+        # Store the templates again, renders of the old configuration may
+        # have replaced them meanwhile
+        self._compiled_templates = (config, config.version, self.template,
+                                    self.href_template, templates)
+
+    def watch_config_file(self, path, interval=2.0, **kwargs):
+        """
+        Reload the configuration file in a background thread when it
+        changes.
+
+        The modification time and size of the file are checked every
+        interval seconds. If a reload fails, the old configuration is kept
+        and the error is available in the "config_error" attribute until a
+        reload succeeds.
+        :param path: path of the configuration file, see from_config_file
+        :param interval: seconds between checks for changes
+        :param kwargs: options which override the options in the file
+        """
+        self.stop_watching()
+        self._watcher = _ConfigWatcher(self, path, interval, kwargs)
+
+    def stop_watching(self):
+        """
+        Stop the thread started by watch_config_file.
+        """
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    @property
+    def config_error(self):
+        """
+        The exception of the last failed reload of the watched
+        configuration file, or None.
+        """
+        return self._watcher.error if self._watcher else None
+
+    @property
+    def config(self):
+        """
+        The instance configuration. Changes to it, or assigning a new
+        configuration dict, are picked up by the next render.
+        """
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        self._config = _Config(config)
+
+    @classmethod
+    def _parse_args(cls, args, kwargs):
+        """
+        Parse kwargs and return a dict.
+        :param kwargs: dict to parse
+        :return:
+        """
+        if len(args) > 2:
+            raise ValueError('a maximum of 2 optional argument may be given'
+                             ' ({} were given.)'.format(len(args)))
+        if not cls.option_names.issuperset(kwargs):
+            for k in kwargs.keys():
+                if k not in cls.option_names:
+                    raise TypeError('unknown option {}'.format(k))
+        return kwargs
+
+    @classmethod
+    def _determine_type(cls, values):
+        is_float = False
         for value in values:
             try:
                 float(value)
@@ -164,9 +1316,9 @@ class Badge(object):
         value_type = cls._determine_type(list(thresholds['colors'].keys()))
         if order == 'auto' and value_type == 'str':
             return None
-        casters = {'str': lambda s: str(s),
-                   'int': lambda i: int(i),
-                   'float': lambda f: float(f), }
+        casters = {'str': str,
+                   'int': int,
+                   'float': float, }
         return casters[value_type]
 
     @classmethod
@@ -188,89 +1340,706 @@ class Badge(object):
         Shades the color between color1 and color2, based on the given
         fraction.
         :param fraction: distance between color1 and color2.
-        :param color1: color string in either #rgb or #rrggbb format
-        :param color2:  color string in either #rgb or #rrggbb format
+        :param color1: color string, see _parse_color
+        :param color2:  color string, see _parse_color
         :return: new color string
         """
-        cols = []
-        for c in [color1, color2]:
-            if len(c) == 4:
-                cols.append([16 * int(i, 16) for i in list(c[1:])])
-            elif len(c) == 7:
-                cols.append([int(c[1:3], 16),
-                             int(c[3:5], 16),
-                             int(c[5:7], 16)])
-            else:
-                raise ValueError('{}: Error: neither 4 nor 7 characters long'
-                                 ''.format(c))
-        shade = ['#']
-        for i in range(0, 3):
-            distance = cols[1][i] - cols[0][i]
-            shade.append('{:02x}'
-                         ''.format(int(cols[0][i] + distance * fraction)))
-        return ''.join(shade)
+        return cls._shade_rgb(fraction,
+                              cls._parse_color(color1),
+                              cls._parse_color(color2))
 
     @classmethod
-    def _get_value_background(cls, config):
+    def _parse_color(cls, color):
         """
-        Return the calculated background color based on the "value" key.
-
-        :param config: the config dict
-        :return: color string
+        Parse a color string into a tuple of R, G, B and optionally A
+        integers. The results are kept, since the same colors are parsed
+        over and over.
+        :param color: color string in #rgb, #rgba, #rrggbb or #rrggbbaa
+                      format, or a CSS color name
+        :return: tuple with the R, G, B and, if given, A values
         """
         try:
-            this = config['thresholds'][config['label']]
-            order = this.get('order', 'auto')
-            if order != 'strict':
-                caster = cls._get_caster_func(order, this)
-                if caster:
-                    thresholds = sorted(list(this['colors'].keys()),
-                                        key=lambda v: caster(v))
-                    last = thresholds[0]
-                    for threshold in thresholds:
-                        if caster(config['value']) <= caster(threshold):
-                            if this.get('shade', None):
-                                fraction = cls._get_fraction(last,
-                                                             threshold,
-                                                             caster(config['value']))
-                                return cls._shade(fraction,
-                                                  this['colors'][last],
-                                                  this['colors'][threshold])
-                            return this['colors'][threshold]
-                        last = threshold
-                    return this['above']
-            return this['colors'][config['value']]
+            return _parsed_colors[color]
         except KeyError:
             pass
+        name = _css_colors.get(color.lower(), color)
+        if len(name) in (4, 5) and name[0] == '#':
+            rgb = tuple(16 * int(i, 16) for i in name[1:])
+        elif len(name) in (7, 9) and name[0] == '#':
+            rgb = tuple(int(name[i:i + 2], 16)
+                        for i in range(1, len(name), 2))
+        else:
+            raise ValueError('{}: Error: neither a #rgb, #rgba, #rrggbb or'
+                             ' #rrggbbaa color, nor a color name'
+                             ''.format(color))
+        if len(_parsed_colors) < 4096:
+            _parsed_colors[color] = rgb
+        return rgb
+
+    @classmethod
+    def _shade_rgb(cls, fraction, rgb1, rgb2):
+        """
+        Same as _shade, but with already parsed colors.
+        :param fraction: distance between rgb1 and rgb2.
+        :param rgb1: tuple with R, G, B and optionally A values
+        :param rgb2: tuple with R, G, B and optionally A values
+        :return: new color string, with alpha if any of the colors has it
+        """
+        if len(rgb1) == 3 and len(rgb2) == 3:
+            r1, g1, b1 = rgb1
+            r2, g2, b2 = rgb2
+            return ''.join(('#',
+                            _hex_bytes[int(r1 + (r2 - r1) * fraction)],
+                            _hex_bytes[int(g1 + (g2 - g1) * fraction)],
+                            _hex_bytes[int(b1 + (b2 - b1) * fraction)]))
+        rgb1 = rgb1 + (255,) * (4 - len(rgb1))
+        rgb2 = rgb2 + (255,) * (4 - len(rgb2))
+        return '#' + ''.join([_hex_bytes[int(c1 + (c2 - c1) * fraction)]
+                              for c1, c2 in zip(rgb1, rgb2)])
+
+    def _get_threshold(self, thresholds, label):
+        """
+        Return the compiled threshold configuration for the label.
+
+        Labels without their own configuration use the configuration of
+        the best matching glob pattern, see _LabelPatterns.
+
+        The compiled thresholds of configured (interned) tables are kept in
+        the table, so that each label is only compiled and matched once for
+        all instances sharing the table.
+        :param thresholds: the "thresholds" dict to look in
+        :param label: the badge label
+        :return: _Threshold object, or None if there is no usable
+                 configuration for the label
+        """
+        if thresholds.__class__ is not _ThresholdTable:
+            return self._compile_threshold(thresholds, label)
+        compiled = thresholds.compiled
+        threshold = compiled.get(label, _MISSING)
+        if threshold is _MISSING:
+            if label in thresholds:
+                threshold = compiled[label] = self._compile_threshold(
+                    thresholds, label)
+                return threshold
+            patterns = thresholds.patterns
+            if patterns is None:
+                patterns = thresholds.patterns = _LabelPatterns(thresholds)
+            pattern = patterns.match(label)
+            if pattern is not None:
+                threshold = self._get_threshold(thresholds, pattern)
+            else:
+                threshold = None
+            # Labels matching patterns are kept too, up to a limit, since
+            # there may be any number of them
+            if len(compiled) < 4096:
+                compiled[label] = threshold
+        return threshold
 
+    @classmethod
+    def _compile_threshold(cls, thresholds, label):
+        if label not in thresholds:
+            label = _LabelPatterns(thresholds).match(label)
+            if label is None:
+                return None
         try:
-            return config['value_backgrounds'][config['value']]
+            return _Threshold(thresholds[label])
         except KeyError:
-            pass
+            return None
+
+    def _get_value_background(self, config):
+        """
+        Return the calculated background color based on the "value" key.
+
+        :param config: the config dict
+        :return: color string
+        """
+        value = config['value']
+        threshold = self._get_threshold(config['thresholds'], config['label'])
+        if threshold is not None:
+            try:
+                return threshold.lookup(value)
+            except KeyError:
+                pass
+
+        backgrounds = config['value_backgrounds']
+        if value in backgrounds:
+            return backgrounds[value]
 
         return config['value_background']
 
+    def resolve_backgrounds(self, label, values, **kwargs):
+        """
+        Return the value backgrounds for many values with the same label,
+        as to_html would render them.
+
+        Numeric thresholds are resolved for all values at once if numpy is
+        installed.
+        :param label: the badge label
+        :param values: iterable with badge values
+        :param kwargs: same keyword arguments as to_html
+        :return: list with color strings
+        """
+        conf = self._merge_config((), kwargs)
+        conf['label'] = label
+        return self._resolve_backgrounds(conf, list(values))
+
+    def _resolve_backgrounds(self, conf, values):
+        label = conf['label']
+        threshold = self._get_threshold(conf['thresholds'], label)
+        if threshold is None:
+            colors = [_MISSING] * len(values)
+        else:
+            colors = threshold.lookup_many(values, _import_numpy())
+        backgrounds = conf['value_backgrounds']
+        value_background = conf['value_background']
+        return [backgrounds.get(value, value_background)
+                if color is _MISSING else color
+                for color, value in zip(colors, values)]
+
     def to_html(self, *args, **kwargs):
         """
         Render HTML for this badge
         :return: string with HTML
         """
-        conf = deepcopy(self.config)
-        conf.update(self._parse_args(args, kwargs))
+        if self._cache is not None:
+            return self._cache.render(self, args, kwargs)
+        return self._to_html(args, kwargs)
+
+    def _to_html(self, args, kwargs):
+        return self._render_html(self._merge_config(args, kwargs))
+
+    def render_spec(self, spec, format='html'):
+        """
+        Render a BadgeSpec.
+
+        With the cache enabled, the spec itself is used as key.
+        :param spec: BadgeSpec
+        :param format: "html" or "svg"
+        :return: string with HTML or SVG
+        """
+        if format == 'svg':
+            conf = self._spec_config(spec)
+            conf['value_background'] = self._get_value_background(conf)
+            return self._render_svg(conf)
+        if self._cache is not None:
+            try:
+                hash(spec)
+            except TypeError:
+                pass
+            else:
+                return self._cache.get(self, spec, self._render_spec, spec)
+        return self._render_spec(spec)
+
+    def _render_spec(self, spec):
+        return self._render_html(self._spec_config(spec))
+
+    def _spec_config(self, spec):
+        conf = _Overlay(self.config, spec.options)
+        conf['label'] = spec.label
+        conf['value'] = spec.value
+        return conf
+
+    def to_svg(self, *args, **kwargs):
+        """
+        Render SVG for this badge.
+
+        The options and thresholds are the same as for to_html. The width
+        of the texts is estimated from the character widths of DejaVu Sans,
+        since the text can not be measured.
+        :return: string with SVG
+        """
+        conf = self._merge_config(args, kwargs)
+        conf['value_background'] = self._get_value_background(conf)
+        return self._render_svg(conf)
+
+    def to_sparkline(self, label, values, format='html', bar_width=2,
+                     **kwargs):
+        """
+        Render a badge with a bar per number in the value part.
+
+        The bars are as high as the numbers, scaled between the lowest and
+        the highest, and colored by the thresholds of the label, like
+        values rendered by to_html. The value part has the
+        "value_background" color.
+        :param label: the badge label
+        :param values: sequence with numbers
+        :param format: "html" or "svg"
+        :param bar_width: width of the bars in pixels
+        :param kwargs: same keyword arguments as to_html
+        :return: string with HTML or SVG
+        """
+        conf = self._merge_config((label,), kwargs)
+        values = list(values)
+        colors = self._resolve_backgrounds(conf, values)
+        heights = _sparkline_heights(values)
+        if format == 'svg':
+            conf['value'] = values[-1] if values else ''
+            return self._render_svg(conf, (heights, colors, bar_width))
+
+        start = '<span style="width:{}px;height:'.format(bar_width)
+        parts = []
+        for height, color in zip(heights, colors):
+            parts += (start, _percents[height], ';background:', color,
+                      ';"></span>')
+        conf['value'] = self.sparkline_template.format(bars=''.join(parts))
+        if conf['escape']:
+            # Escape all but the bars
+            conf['escape'] = False
+            conf['label'] = _escape_html(conf['label'])
+            conf['url'] = _escape_html(conf['url'])
+        return self._get_templates(conf).render(conf, self)
+
+    def _render_svg(self, conf, sparkline=None):
+        """
+        Render SVG from a config dict returned by _merge_config.
+        :param conf: config dict with the "value_background" set
+        :param sparkline: tuple with the bar heights in percent, the bar
+                          colors and the bar width, to render bars instead of
+                          the value
+        :return: string with SVG
+        """
+        font_px, top, right, bottom, left, radius = _svg_metrics(
+            conf['font_size'], conf['padding'], conf['border_radius'])
+        label = str(conf['label'])
+        value = str(conf['value'])
+        label_width = left + _text_width(label, font_px) + right
+        if sparkline:
+            heights, colors, bar_width = sparkline
+            value_width = left + max(0, len(heights) * (bar_width + 1) - 1) \
+                + right
+        else:
+            value_width = left + _text_width(value, font_px) + right
+        width = label_width + value_width
+        height = top + font_px * _font_height + bottom
+        baseline = top + font_px * _font_ascent
+        r = min(radius, height / 2, label_width / 2, value_width / 2)
+        label = _escape_xml(label)
+        value = _escape_xml(value)
+
+        parts = [(label, label_width / 2, conf['label_text_color'],
+                  conf['label_text_shadow'])]
+        if not sparkline:
+            parts.append((value, label_width + value_width / 2,
+                          conf['value_text_color'], conf['value_text_shadow']))
+        texts = []
+        for text, x, color, shadow in parts:
+            shadow = _svg_shadow(shadow, font_px)
+            if shadow:
+                texts.append(self.svg_text_template.format(
+                    x=x + shadow[0], y=baseline + shadow[1],
+                    color=shadow[2], text=text))
+            texts.append(self.svg_text_template.format(
+                x=x, y=baseline, color=_escape_xml(color), text=text))
+        if sparkline:
+            scale = (height - top - bottom) / 100.0
+            x = label_width + left
+            for percent, color in zip(heights, colors):
+                texts.append(self.svg_bar_template.format(
+                    x=x, y=height - bottom - percent * scale,
+                    width=bar_width, height=percent * scale,
+                    color=_escape_xml(color)))
+                x += bar_width + 1
+
+        link_start = link_end = ''
+        if conf['url']:
+            link_start = '<a xlink:href="{}"{}>'.format(
+                _escape_xml(conf['url']),
+                self._link_attributes(_escape_xml(conf['link_target'])))
+            link_end = '</a>'
+        return self.svg_template.format(
+            width=width, height=height, radius=r,
+            label_width=label_width, bottom=height - r, right=width - r,
+            title='{}: {}'.format(label, value),
+            link_start=link_start, link_end=link_end,
+            label_background=_escape_xml(conf['label_background']),
+            value_background=_escape_xml(conf['value_background']),
+            font_family=_escape_xml(conf['font_family']),
+            font_size=font_px,
+            texts=''.join(texts))
+
+    def iter_html(self, rows, **kwargs):
+        """
+        Render HTML for many badges, one per row.
+
+        The keyword arguments are validated and merged with the instance
+        configuration once, and then used for all rows.
+        :param rows: iterable with (label, value) pairs
+        :param kwargs: same keyword arguments as to_html
+        :return: iterator yielding a string with HTML per row
+        """
+        return self._iter_html(self._merge_config((), kwargs), rows)
+
+    def _iter_html(self, conf, rows):
+        value_background = conf['value_background']
+        templates = self._get_templates(conf)
+        for label, value in rows:
+            conf['label'] = label
+            conf['value'] = value
+            # Restore the fallback color before looking up the new one
+            conf['value_background'] = value_background
+            conf['value_background'] = self._get_value_background(conf)
+            yield templates.render(conf, self)
+
+    def render_many(self, rows, **kwargs):
+        """
+        Render HTML for many badges, one per row.
+
+        Same as iter_html, but returns a list.
+        :param rows: iterable with (label, value) pairs
+        :param kwargs: same keyword arguments as to_html
+        :return: list with HTML strings
+        """
+        return list(self.iter_html(rows, **kwargs))
+
+    def render_parallel(self, rows, workers=None, chunksize=1000, **kwargs):
+        """
+        Render HTML for many badges, one per row, in a pool of processes.
+
+        The badge, with its compiled templates and thresholds, and the
+        keyword arguments are sent to each worker process once. The rows
+        are sent in chunks of chunksize rows.
+        :param rows: iterable with (label, value) pairs
+        :param workers: number of processes, default is the number of CPUs
+        :param chunksize: number of rows per chunk
+        :param kwargs: same keyword arguments as to_html
+        :return: list with HTML strings, in the same order as rows
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        conf = self._merge_config((), kwargs)
+        if workers == 1:
+            return list(self._iter_html(conf, rows))
+        # Compile everything once here instead of in every worker
+        self._get_templates(conf)
+        for label in self.config['thresholds']:
+            self._get_threshold(self.config['thresholds'], label)
+
+        results = []
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(self, kwargs)) as executor:
+            for html, css_rules in executor.map(_render_chunk,
+                                                _chunks(rows, chunksize)):
+                results.extend(html)
+                self._css_rules.update(css_rules)
+        return results
+
+    def iter_page(self, rows, layout='grid', columns=None, title='',
+                  fragment=False, buffer_size=65536, **kwargs):
+        """
+        Render an HTML page with a badge per row, in chunks.
+
+        The badges are rendered as the chunks are consumed, so only one
+        chunk is in memory at a time. The start of the page is returned
+        as the first chunk, before any badge is rendered. With the
+        "css_class" option, each chunk starts with a style element with
+        the CSS rules added since the previous chunk.
+        :param rows: iterable with (label, value) pairs
+        :param layout: "grid", "table", or None for badges separated by
+                       newlines
+        :param columns: number of columns of the grid or table. The grid
+                        wraps to the width of the page by default, and the
+                        table has 4 columns
+        :param title: title of the page
+        :param fragment: only return the badges in the layout, without
+                         html, head and body elements
+        :param buffer_size: number of characters to collect before
+                            returning a chunk
+        :param kwargs: same keyword arguments as to_html
+        :return: iterator yielding strings
+        """
+        if layout not in ('grid', 'table', None):
+            raise ValueError('{}: Error: unknown layout. Valid are: grid,'
+                             ' table, None'.format(layout))
+        conf = self._merge_config((), kwargs)
+        head = ''
+        if not fragment:
+            head = '<!DOCTYPE html>\n<html><head><meta charset="utf-8">' \
+                   '<title>{}</title></head><body>\n' \
+                   ''.format(_escape_xml(title))
+        before, after, cell = '', '', '{}\n'
+        end_row = None
+        if layout == 'grid' and columns:
+            before = '<div style="display:grid;gap:4px;' \
+                     'grid-template-columns:repeat({},max-content);">\n' \
+                     ''.format(int(columns))
+        elif layout == 'grid':
+            before = '<div style="display:flex;flex-wrap:wrap;gap:4px;">\n'
+        if layout == 'grid':
+            after, cell = '</div>\n', '<div>{}</div>\n'
+        elif layout == 'table':
+            columns = int(columns or 4)
+            before, after = '<table>\n<tr>', '</tr>\n</table>\n'
+            cell, end_row = '<td>{}</td>', '</tr>\n<tr>'
+        yield head + before
+
+        emitted = 0
+        chunk = []
+        size = 0
+        index = 0
+        for html in self._iter_html(conf, rows):
+            if end_row and index and index % columns == 0:
+                chunk.append(end_row)
+            html = cell.format(html)
+            chunk.append(html)
+            size += len(html)
+            index += 1
+            if size >= buffer_size:
+                styles, emitted = self._new_css_rules(emitted)
+                yield styles + ''.join(chunk)
+                chunk = []
+                size = 0
+        styles, emitted = self._new_css_rules(emitted)
+        yield styles + ''.join(chunk) + after + (
+            '' if fragment else '</body></html>\n')
+
+    def write_page(self, fp, rows, **kwargs):
+        """
+        Write an HTML page with a badge per row to a file, in chunks.
+
+        The file is flushed after each chunk, if it can be.
+        :param fp: file object opened for writing text
+        :param rows: iterable with (label, value) pairs
+        :param kwargs: same keyword arguments as iter_page
+        """
+        flush = getattr(fp, 'flush', None)
+        for chunk in self.iter_page(rows, **kwargs):
+            fp.write(chunk)
+            if flush:
+                flush()
+
+    def _new_css_rules(self, start):
+        """
+        Return a style element with the CSS rules added after the first
+        start rules, and the new number of rules.
+        """
+        rules = list(self._css_rules.items())[start:]
+        if not rules:
+            return '', start
+        return '<style>\n{}</style>\n'.format(self._format_css_rules(
+            rules)), start + len(rules)
+
+    @classmethod
+    def _format_css_rules(cls, rules):
+        return ''.join('.{}{{{}}}\n'.format(name, declarations)
+                       for name, declarations in rules)
+
+    def _merge_config(self, args, kwargs):
+        """
+        Return the instance configuration overlaid with the arguments, ready
+        to be passed to _render_html.
+        :param args: positional arguments
+        :param kwargs: keyword arguments
+        :return: _Overlay on the instance configuration
+        """
+        conf = _Overlay(self.config, self._parse_args(args, kwargs))
         if len(args) > 0:
             conf['label'] = args[0]
         if len(args) > 1:
             conf['value'] = args[1]
+        return conf
+
+    @classmethod
+    def _link_attributes(cls, link_target):
+        """
+        Return the attributes for the link_target option.
+        """
+        if not link_target:
+            return ''
+        attributes = ' target="{}"'.format(link_target)
+        if link_target == '_blank':
+            attributes += ' rel="noopener noreferer"'
+        return attributes
+
+    def _compile_templates(self, conf):
+        """
+        Compile the templates with all options, except the row_fields,
+        filled in from conf.
+        :param conf: config dict
+        :return: _Templates object
+        """
+        escape = conf['escape']
+        link_target = self._link_attributes(conf['link_target'])
+        link = _Template(self.href_template,
+                         _Overlay(conf, link_target=link_target),
+                         self.row_fields, escape)
+        if not conf['css_class']:
+            return _Templates(_Template(self.template, conf, self.row_fields,
+                                        escape),
+                              link)
+        label_class = self._add_css_rule(
+            conf['css_class'],
+            _Template(self.label_style, conf, ()).render(conf))
+        return _Templates(_Template(self.class_template,
+                                    _Overlay(conf, label_class=label_class),
+                                    self.row_fields, escape),
+                          link,
+                          _Template(self.value_style, conf, self.row_fields))
+
+    def _add_css_rule(self, prefix, declarations):
+        """
+        Add a rule to the stylesheet, unless it is already there.
+
+        The class name is derived from the declarations, so the same style
+        gets the same class name in all instances and processes.
+        :param prefix: the "css_class" option
+        :param declarations: CSS declarations for the rule
+        :return: the class name
+        """
+        from hashlib import sha1
+
+        name = '{}-{}'.format(
+            prefix, sha1(declarations.encode('utf-8')).hexdigest()[:10])
+        self._css_rules[name] = declarations
+        return name
+
+    def enable_cache(self, maxsize=1024):
+        """
+        Cache the HTML returned by to_html.
+
+        The cache is keyed by the arguments to to_html, and holds at most
+        maxsize badges, evicting the least recently used. It is cleared
+        when the configuration of the instance changes. Calls with
+        unhashable arguments are not cached.
+        :param maxsize: maximum number of cached badges
+        """
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1 ({} was given.)'
+                             ''.format(maxsize))
+        self._cache = _RenderCache(maxsize)
+
+    def enable_instrumentation(self, callback=None):
+        """
+        Start counting the calls and time of the rendering phases of this
+        badge, see Instrumentation.
+
+        The instrumentation is kept in the "instrumentation" attribute. The
+        methods of the phases are replaced with timing wrappers while any
+        instrumentation is enabled, so there is no overhead when none is.
+        :param callback: function called with the phase name and the
+                         nanoseconds after each call
+        :return: Instrumentation with the counters
+        """
+        instrumentation = Instrumentation(callback)
+        _set_instrumentation(self, instrumentation)
+        return instrumentation
+
+    def disable_instrumentation(self):
+        """
+        Stop the instrumentation started by enable_instrumentation.
+        """
+        _set_instrumentation(self, None)
+
+    def disable_cache(self):
+        """
+        Stop caching the HTML returned by to_html.
+        """
+        self._cache = None
+
+    def cache_info(self):
+        """
+        Return statistics for the cache enabled by enable_cache.
+        :return: CacheInfo named tuple
+        """
+        if self._cache is None:
+            return CacheInfo(0, 0, 0, 0, 0)
+        return self._cache.info()
+
+    def cache_clear(self):
+        """
+        Remove all badges from the cache and reset the statistics.
+        """
+        if self._cache is not None:
+            self._cache.clear()
+
+    def stylesheet(self):
+        """
+        Return the CSS rules for the classes in the badges rendered so far
+        with the "css_class" option set.
+
+        There is one rule for each distinct style of the label and value
+        parts, so the stylesheet should be included after the badges have
+        been rendered.
+        :return: string with CSS
+        """
+        # A copy, since other threads may add rules while this one reads
+        return self._format_css_rules(list(self._css_rules.items()))
+
+    def _get_templates(self, conf):
+        """
+        Return the compiled templates for conf.
+
+        Configurations which override other options than the row_fields are
+        compiled once for each distinct set of overrides, and the most
+        recently used are kept until the configuration changes. Overrides
+        with unhashable values are compiled on every call. All other
+        configurations use _instance_templates.
+        :param conf: _Overlay returned by _merge_config
+        :return: _Templates object
+        """
+        overrides = conf.keys() - self.row_fields
+        # The configuration the render started with, in case it is replaced
+        config = conf.base
+        if not overrides:
+            return self._instance_templates(config)
+        # The types are part of the key, since 1, 1.0 and True are equal
+        key = (self.template, self.href_template,
+               tuple(sorted((name, conf[name].__class__, conf[name])
+                            for name in overrides)))
+        try:
+            hash(key)
+        except TypeError:
+            return self._compile_templates(conf)
+        cached = self._override_templates
+        if cached[0] is not config or cached[1] != config.version:
+            cached = (config, config.version, OrderedDict())
+            self._override_templates = cached
+        templates = cached[2].get(key)
+        if templates is None:
+            templates = self._compile_templates(conf)
+            cached[2][key] = templates
+            if len(cached[2]) > self.override_templates_size:
+                try:
+                    cached[2].popitem(last=False)
+                except KeyError:
+                    # Emptied by another thread
+                    pass
+        else:
+            try:
+                cached[2].move_to_end(key)
+            except KeyError:
+                pass
+        return templates
+
+    def _instance_templates(self, config=None):
+        """
+        Return the templates compiled from the instance configuration.
+
+        The compiled templates are kept until the configuration or the
+        templates change, so a new object means that the output may differ.
+        :param config: the instance configuration, default self.config
+        :return: _Templates object
+        """
+        if config is None:
+            config = self.config
+        compiled = self._compiled_templates
+        if (compiled[0] is not config or compiled[1] != config.version
+                or compiled[2] is not self.template
+                or compiled[3] is not self.href_template):
+            compiled = ((config, config.version, self.template,
+                         self.href_template)
+                        + (self._compile_templates(config),))
+            self._compiled_templates = compiled
+        return compiled[4]
+
+    def _render_html(self, conf):
+        """
+        Render HTML from a config dict returned by _merge_config.
+        :param conf: config dict, the "value_background" key is updated
+        :return: string with HTML
+        """
         conf['value_background'] = self._get_value_background(conf)
-        if conf['url']:
-            if conf['link_target']:
-                target = conf['link_target']
-                conf['link_target'] = ' target="{}"'.format(target)
-                if target == '_blank':
-                    conf['link_target'] += ' rel="noopener noreferer"'
-            return (self.href_template.format(**conf)
-                    + self.template.format(**conf) + '</a>')
-        return self.template.format(**conf)
+        return self._get_templates(conf).render(conf, self)
 
     @classmethod
     def make_badge(cls, *args, **kwargs):
@@ -279,4 +2048,792 @@ class Badge(object):
         :param kwargs:
         :return:
         """
-        return Badge().to_html(*args, **kwargs)
+        badge = Badge._default_badge
+        if badge is None or \
+                badge._default_config is not Badge.default_config:
+            with Badge._default_badge_lock:
+                badge = Badge._default_badge
+                if badge is None or \
+                        badge._default_config is not Badge.default_config:
+                    badge = Badge()
+                    badge._default_config = Badge.default_config
+                    Badge._default_badge = badge
+        return badge.to_html(*args, **kwargs)
+
+
+def _load_config_file(path):
+    """
+    Read the options in a JSON, TOML or YAML configuration file.
+    :param path: path of the file
+    :return: the options
+    """
+    extension = path.rpartition('.')[2].lower()
+    if extension == 'toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, 'rb') as fp:
+            return tomllib.load(fp)
+    if extension in ('yaml', 'yml'):
+        import yaml
+        with open(path, encoding='utf-8') as fp:
+            return yaml.safe_load(fp)
+    import json
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+class _ConfigWatcher(object):
+    """
+    Thread which reloads the configuration file of a Badge when the
+    modification time or size of the file changes.
+    """
+    def __init__(self, badge, path, interval, kwargs):
+        import threading
+
+        self.path = path
+        self.interval = interval
+        self.kwargs = kwargs
+        self.error = None
+        self.stat = self._stat()
+        self.stopped = stopped = threading.Event()
+        # Only a weak reference, so the thread does not keep the badge alive,
+        # and stops when the badge is collected
+        self.badge = ref(badge, lambda _: stopped.set())
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='abadge-config-watcher')
+        self.thread.start()
+
+    def _stat(self):
+        import os
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.badge() is None:
+                return
+            stat = self._stat()
+            if stat is None or stat == self.stat:
+                continue
+            badge = self.badge()
+            if badge is None:
+                return
+            try:
+                badge.reload_config_file(self.path, **self.kwargs)
+            except Exception as e:
+                # Try again on the next check, the file may be half written
+                self.error = e
+            else:
+                self.stat = stat
+                self.error = None
+            badge = None
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Instrumentation(object):
+    """
+    Call counts and cumulative time of the phases of rendering.
+
+    The phases are:
+
+    - parse_args: validation of the arguments
+    - value_background: threshold resolution of the value background,
+      including shading
+    - shade: shading between two colors
+    - format: filling in the HTML or SVG templates
+
+    The times are in nanoseconds, and include the time of nested phases.
+    """
+    phases = ('parse_args', 'value_background', 'shade', 'format')
+
+    def __init__(self, callback=None):
+        """
+        :param callback: function called with the phase name and the
+                         nanoseconds after each call, in the calling thread
+        """
+        self.callback = callback
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Set all counters to zero.
+        """
+        with self.lock:
+            self.counters = dict((phase, [0, 0]) for phase in self.phases)
+
+    def record(self, phase, nanoseconds):
+        with self.lock:
+            counter = self.counters[phase]
+            counter[0] += 1
+            counter[1] += nanoseconds
+        if self.callback:
+            self.callback(phase, nanoseconds)
+
+    def snapshot(self):
+        """
+        :return: dict with a (calls, nanoseconds) tuple per phase
+        """
+        with self.lock:
+            return dict((phase, tuple(counter))
+                        for phase, counter in self.counters.items())
+
+
+# The instrumented methods, as (class, attribute, phase, function returning
+# the Instrumentation from the arguments and the current one of the thread).
+# The class methods have no badge, so they record to the instrumentation of
+# the method they are called from, which for _merge_config is not a phase.
+_instrumented = ((Badge, '_merge_config', None,
+                  lambda args, current: args[0].instrumentation),
+                 (Badge, '_parse_args', 'parse_args',
+                  lambda args, current: getattr(current, 'instrumentation',
+                                                None)
+                  or args[0].instrumentation),
+                 (Badge, '_get_value_background', 'value_background',
+                  lambda args, current: args[0].instrumentation),
+                 (Badge, '_shade_rgb', 'shade',
+                  lambda args, current: getattr(current, 'instrumentation',
+                                                None)
+                  or args[0].instrumentation),
+                 (_Templates, 'render', 'format',
+                  lambda args, current: args[2].instrumentation),
+                 (Badge, '_render_svg', 'format',
+                  lambda args, current: args[0].instrumentation))
+# The original attributes while the wrappers are installed, and the number of
+# enabled instrumentations
+_instrumented_originals = {}
+_instrumentation_users = 0
+_instrumentation_lock = Lock()
+
+
+def _set_instrumentation(owner, instrumentation):
+    """
+    Set or remove the instrumentation of a badge or a Badge class, and
+    install the timing wrappers while any instrumentation is enabled.
+    :param owner: Badge object or class
+    :param instrumentation: Instrumentation, or None to remove it
+    """
+    global _instrumentation_users
+    with _instrumentation_lock:
+        enabled = vars(owner).get('instrumentation') is not None
+        if instrumentation is not None:
+            setattr(owner, 'instrumentation', instrumentation)
+            _instrumentation_users += not enabled
+        elif enabled:
+            if isinstance(owner, type):
+                owner.instrumentation = None
+            else:
+                del owner.instrumentation
+            _instrumentation_users -= 1
+        if _instrumentation_users and not _instrumented_originals:
+            _install_instrumentation()
+        elif not _instrumentation_users:
+            while _instrumented_originals:
+                (cls, name), original = _instrumented_originals.popitem()
+                setattr(cls, name, original)
+
+
+def _install_instrumentation():
+    """
+    Replace the methods of the phases with timing wrappers, which record to
+    the instrumentation of the badge they are called for.
+    """
+    from threading import local
+    from time import perf_counter_ns
+
+    current = local()
+
+    def timed(func, phase, get_instrumentation):
+        def wrapper(*args, **kwargs):
+            instrumentation = get_instrumentation(args, current)
+            if instrumentation is None:
+                return func(*args, **kwargs)
+            outer = getattr(current, 'instrumentation', None)
+            current.instrumentation = instrumentation
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current.instrumentation = outer
+                if phase:
+                    instrumentation.record(phase, perf_counter_ns() - start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    for cls, name, phase, get_instrumentation in _instrumented:
+        original = cls.__dict__[name]
+        _instrumented_originals[(cls, name)] = original
+        if isinstance(original, classmethod):
+            wrapped = classmethod(timed(original.__func__, phase,
+                                        get_instrumentation))
+        else:
+            wrapped = timed(original, phase, get_instrumentation)
+        setattr(cls, name, wrapped)
+
+
+def enable_instrumentation(callback=None):
+    """
+    Start counting calls and time of the rendering phases of all badges
+    which have no instrumentation of their own.
+
+    The instrumentation is global: it is set as the class attribute
+    Badge.instrumentation, and replaces an instrumentation enabled before.
+    See Badge.enable_instrumentation to instrument a single badge.
+    :param callback: function called with the phase name and the
+                     nanoseconds after each call
+    :return: Instrumentation with the counters
+    """
+    instrumentation = Instrumentation(callback)
+    _set_instrumentation(Badge, instrumentation)
+    return instrumentation
+
+
+def disable_instrumentation():
+    """
+    Stop the instrumentation started by enable_instrumentation.
+    """
+    _set_instrumentation(Badge, None)
+
+
+def _read_records(fp, source, input_format):
+    """
+    Read badge records from a file.
+    :param fp: file object to read from
+    :param source: name of the file, for error messages
+    :param input_format: "jsonl" or "csv"
+    :return: generator yielding (line number, dict) tuples
+    """
+    if input_format == 'csv':
+        import csv
+        reader = csv.DictReader(fp)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    import json
+    for line_num, line in enumerate(fp, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError('{}:{}: {}'.format(source, line_num, e))
+            yield line_num, record
+
+
+def _safe_file_name(text):
+    """
+    Replace the characters in text which can not be used in a file name.
+    """
+    text = str(text)
+    for c in ('/', '\\', '\0'):
+        text = text.replace(c, '_')
+    return text
+
+
+class TreeWriter(object):
+    """
+    Write files to a directory, skipping files whose content is unchanged.
+
+    The hashes of the written files are kept in an index file in the
+    directory, so the files do not have to be read to find out if they
+    changed. Changed files are written to temporary files, which are synced
+    to disk and renamed over the old files in batches. Files in the index
+    which were not written again are removed when the writer is closed.
+
+    Usage::
+
+        with TreeWriter('badges') as writer:
+            for label, value in rows:
+                writer.write(label + '.html', badge.to_html(label, value))
+    """
+    index_name = '.abadge-index.json'
+
+    def __init__(self, directory, fsync=True, batch_size=256):
+        """
+        :param directory: the directory to write to, created if missing
+        :param fsync: sync the files to disk before they replace the old
+        :param batch_size: number of files to write before syncing
+        """
+        import json
+        import os
+
+        self.directory = directory
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.written = self.unchanged = self.removed = 0
+        self._hashes = {}
+        self._pending = []
+        self.closed = False
+        # mkstemp creates files only the owner can read, so give them the
+        # mode that open would
+        umask = os.umask(0)
+        os.umask(umask)
+        self._mode = 0o666 & ~umask
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, self.index_name)) as fp:
+                self._previous = json.load(fp)
+        except (IOError, ValueError):
+            self._previous = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not remove any files if the list of files is incomplete
+        self.close(prune=exc_type is None)
+
+    def write(self, name, content):
+        """
+        Write content to a file, unless it already has that content.
+        :param name: path of the file, relative to the directory
+        :param content: string to write
+        :return: True if the file is written
+        """
+        from hashlib import sha1
+        import os
+        import tempfile
+
+        data = content.encode('utf-8')
+        digest = sha1(data).hexdigest()
+        path = os.path.join(self.directory, name)
+        self._hashes[name] = digest
+        if self._previous.get(name) == digest and os.path.isfile(path):
+            self.unchanged += 1
+            return False
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=parent, prefix='.abadge-')
+        try:
+            os.chmod(temp, self._mode)
+            os.write(fd, data)
+        except BaseException:
+            os.close(fd)
+            os.remove(temp)
+            raise
+        self._pending.append((fd, temp, path))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        self.written += 1
+        return True
+
+    def flush(self):
+        """
+        Sync the pending files to disk and move them into place.
+        """
+        import os
+
+        pending, self._pending = self._pending, []
+        for fd, _, _ in pending:
+            if self.fsync:
+                os.fsync(fd)
+            os.close(fd)
+        for _, temp, path in pending:
+            os.replace(temp, path)
+        if self.fsync and pending:
+            # Make the renames durable, once per directory
+            for parent in set(os.path.dirname(p) for _, _, p in pending):
+                fd = os.open(parent, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def close(self, prune=True):
+        """
+        Write the pending files and the index. Closing a closed writer does
+        nothing.
+        :param prune: remove the files in the previous index which were not
+                      written since the writer was created
+        """
+        import json
+        import os
+
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        if prune:
+            for name in self._previous:
+                if name not in self._hashes:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                        self.removed += 1
+                    except OSError:
+                        pass
+            # A copy, since writing the index adds it to _hashes
+            hashes = dict(self._hashes)
+        else:
+            hashes = dict(self._previous)
+            hashes.update(self._hashes)
+        if hashes != self._previous:
+            self.write(self.index_name, json.dumps(hashes, sort_keys=True,
+                                                   indent=0))
+            self.flush()
+            self.written -= 1
+        self._previous = hashes
+        self._hashes = {}
+
+
+def write_tree(badge, specs, directory, name='{label}.{format}',
+               format='html', fsync=True):
+    """
+    Render badges to files in a directory, writing only changed files.
+
+    See TreeWriter.
+    :param badge: the Badge to render with
+    :param specs: iterable with dicts with the arguments for each badge
+    :param directory: the directory to write to
+    :param name: file name of the badges, with the fields {index}, {label},
+                 {value} and {format}
+    :param format: "html" or "svg"
+    :param fsync: sync the files to disk
+    :return: the closed TreeWriter, with the counters "written",
+             "unchanged" and "removed"
+    """
+    render = badge.to_svg if format == 'svg' else badge.to_html
+    with TreeWriter(directory, fsync) as writer:
+        for index, spec in enumerate(specs):
+            writer.write(name.format(
+                index=index,
+                label=_safe_file_name(spec.get('label', '')),
+                value=_safe_file_name(spec.get('value', '')),
+                format=format), render(**spec))
+    return writer
+
+
+class _BadgeServer(object):
+    """
+    HTTP/1.1 server for badges, serving /badge/<label>/<value>.html and
+    /badge/<label>/<value>.svg.
+    """
+    content_types = {'html': 'text/html; charset=utf-8',
+                     'svg': 'image/svg+xml; charset=utf-8'}
+    reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+               404: 'Not Found', 405: 'Method Not Allowed',
+               431: 'Request Header Fields Too Large'}
+
+    def __init__(self, badge, cache_size=1024, max_age=60,
+                 keep_alive_timeout=15):
+        self.badge = badge
+        self.cache_size = cache_size
+        self.max_age = max_age
+        self.keep_alive_timeout = keep_alive_timeout
+        self.cache = OrderedDict()
+        self.templates = None
+        self.escaped = None
+
+    def start(self, host='127.0.0.1', port=8080):
+        """
+        Start serving on the running event loop.
+        :return: coroutine returning an asyncio.Server
+        """
+        import asyncio
+        return asyncio.start_server(self.handle, host, port)
+
+    def render(self, path):
+        """
+        Return the response for a badge path.
+        :param path: the path of the request, without the query
+        :return: (status, etag, content type, body) tuple
+        """
+        from hashlib import sha1
+        from urllib.parse import unquote
+
+        # New templates means that the configuration has changed
+        templates = self.badge._instance_templates()
+        if templates is not self.templates:
+            self.cache.clear()
+            self.templates = templates
+            # The label and value come from the request, so the HTML is
+            # rendered by a copy of the badge with escaping turned on, which
+            # keeps its own compiled templates
+            badge = self.badge
+            self.escaped = badge.__class__(**dict(badge.config, escape=True))
+            self.escaped.template = badge.template
+            self.escaped.href_template = badge.href_template
+        response = self.cache.get(path)
+        if response is not None:
+            self.cache.move_to_end(path)
+            return response
+
+        parts = path.split('/')
+        if len(parts) != 4 or parts[0] or parts[1] != 'badge':
+            return 404, None, None, b''
+        value, _, extension = parts[3].rpartition('.')
+        if extension not in self.content_types:
+            return 404, None, None, b''
+        label = unquote(parts[2])
+        value = unquote(value)
+        try:
+            if extension == 'svg':
+                body = self.badge.to_svg(label, value)
+            else:
+                body = self.escaped.to_html(label, value)
+            body = body.encode('utf-8')
+        except (TypeError, ValueError):
+            return 400, None, None, b''
+        response = (200, '"{}"'.format(sha1(body).hexdigest()[:20]),
+                    self.content_types[extension], body)
+        self.cache[path] = response
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return response
+
+    def respond(self, method, target, headers):
+        """
+        Return the response for a request.
+        :param method: the request method
+        :param target: the request target
+        :param headers: dict with the request headers, with lower case names
+        :return: bytes with the status line and headers, and bytes with the
+                 body
+        """
+        if method not in ('GET', 'HEAD'):
+            status, etag, content_type, body = 405, None, None, b''
+        else:
+            status, etag, content_type, body = self.render(
+                target.partition('?')[0])
+        lines = []
+        if etag:
+            lines.append('ETag: {}'.format(etag))
+            lines.append('Cache-Control: max-age={}'.format(self.max_age))
+            match = headers.get('if-none-match')
+            if match and (match.strip() == '*' or etag in
+                          (m.strip() for m in match.split(','))):
+                status, body = 304, b''
+            else:
+                lines.append('Content-Type: {}'.format(content_type))
+        elif status == 405:
+            lines.append('Allow: GET, HEAD')
+        if status != 304:
+            lines.append('Content-Length: {}'.format(len(body)))
+        if method == 'HEAD':
+            body = b''
+        head = 'HTTP/1.1 {} {}\r\n{}\r\n'.format(
+            status, self.reasons[status], ''.join(
+                line + '\r\n' for line in lines))
+        return head.encode('latin-1'), body
+
+    async def handle(self, reader, writer):
+        """
+        Serve the requests on one connection.
+        """
+        import asyncio
+
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        self.keep_alive_timeout)
+                except asyncio.LimitOverrunError:
+                    writer.write(b'HTTP/1.1 431 Request Header Fields Too'
+                                 b' Large\r\nConnection: close\r\n'
+                                 b'Content-Length: 0\r\n\r\n')
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                lines = request.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    writer.write(b'HTTP/1.1 400 Bad Request\r\n'
+                                 b'Connection: close\r\n'
+                                 b'Content-Length: 0\r\n\r\n')
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0) or 0)
+                if length:
+                    await reader.readexactly(length)
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' and (
+                    version == 'HTTP/1.1' or connection == 'keep-alive')
+
+                head, body = self.respond(method, target, headers)
+                writer.write(head[:-2])
+                writer.write(b'Connection: keep-alive\r\n\r\n'
+                             if keep_alive else
+                             b'Connection: close\r\n\r\n')
+                if body:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(badge=None, host='127.0.0.1', port=8080, cache_size=1024,
+          max_age=60):
+    """
+    Serve badges over HTTP until interrupted.
+
+    The badges are served as /badge/<label>/<value>.html and
+    /badge/<label>/<value>.svg, with the label and value URL-encoded.
+    The responses have ETags, so that clients can revalidate with
+    If-None-Match, and the cache_size latest responses are cached.
+    :param badge: the Badge to render with, default is a new Badge
+    :param host: address to listen on
+    :param port: port to listen on
+    :param cache_size: maximum number of cached responses
+    :param max_age: value for the "Cache-Control: max-age" header
+    """
+    import asyncio
+
+    server = _BadgeServer(badge or Badge(), cache_size, max_age)
+
+    async def run():
+        async with await server.start(host, port) as listener:
+            await listener.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    """
+    Command line interface, rendering badges for a stream of records.
+    :param argv: command line arguments, sys.argv[1:] if None
+    :return: exit status
+    """
+    import argparse
+    import os
+    import sys
+
+    p = argparse.ArgumentParser(
+        prog='abadge',
+        description='Render badges for records with "label" and "value",'
+                    ' read as JSON Lines or CSV. Other keys in the records'
+                    ' are used as options for the badge.')
+    p.add_argument('input', nargs='*', default=['-'],
+                   help='files to read records from, "-" for stdin'
+                        ' (default)', )
+    p.add_argument('-c', '--config',
+                   help='JSON, TOML or YAML file with the options for all'
+                        ' badges, for example "thresholds"', )
+    p.add_argument('-i', '--input-format',
+                   choices=['jsonl', 'csv'],
+                   default='jsonl',
+                   help='format of the records (default: %(default)s)', )
+    p.add_argument('-f', '--format',
+                   choices=['html', 'svg'],
+                   default='html',
+                   help='format of the badges (default: %(default)s)', )
+    p.add_argument('-o', '--output',
+                   default='-',
+                   help='file to write the badges to, one per line'
+                        ' (default: stdout)', )
+    p.add_argument('-d', '--output-dir',
+                   help='write each badge to a file in this directory'
+                        ' instead', )
+    p.add_argument('-u', '--update',
+                   action='store_true',
+                   help='with --output-dir, only write the badges that'
+                        ' changed since the last run and remove the badges'
+                        ' that are gone, using an index in the directory', )
+    p.add_argument('-s', '--serve',
+                   metavar='[HOST:]PORT',
+                   help='serve badges over HTTP instead of reading records,'
+                        ' as /badge/<label>/<value>.html or .svg', )
+    p.add_argument('-w', '--watch',
+                   action='store_true',
+                   help='with --serve, reload the --config file when it'
+                        ' changes', )
+    p.add_argument('-n', '--name',
+                   default='{label}.{format}',
+                   help='file name for the badges in --output-dir, with the'
+                        ' fields {index}, {label}, {value} and {format}'
+                        ' (default: %(default)s)', )
+    args = p.parse_args(argv)
+
+    options = {}
+    try:
+        if args.config:
+            options = _load_config_file(args.config)
+        badge = Badge(**options)
+    except (IOError, ImportError, TypeError, ValueError) as e:
+        p.error('{}: {}'.format(args.config, e))
+    if args.serve:
+        host, _, port = args.serve.rpartition(':')
+        if not port.isdigit():
+            p.error('invalid port for --serve: {}'.format(args.serve))
+        if args.config and args.watch:
+            badge.watch_config_file(args.config)
+        serve(badge, host or '127.0.0.1', int(port))
+        return 0
+    render = badge.to_svg if args.format == 'svg' else badge.to_html
+
+    out = writer = None
+    if args.output_dir and args.update:
+        writer = TreeWriter(args.output_dir)
+    elif args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    else:
+        out = sys.stdout
+        if args.output != '-':
+            out = open(args.output, 'w', encoding='utf-8')
+    index = 0
+    try:
+        for source in args.input:
+            fp = sys.stdin
+            if source != '-':
+                fp = open(source, newline='', encoding='utf-8')
+            try:
+                for line_num, record in _read_records(fp, source,
+                                                      args.input_format):
+                    try:
+                        result = render(**record)
+                    except (TypeError, ValueError) as e:
+                        raise ValueError('{}:{}: {}'.format(source, line_num,
+                                                            e))
+                    if out:
+                        out.write(result)
+                        out.write('\n')
+                        continue
+                    name = args.name.format(
+                        index=index,
+                        label=_safe_file_name(record.get('label', '')),
+                        value=_safe_file_name(record.get('value', '')),
+                        format=args.format)
+                    index += 1
+                    if writer:
+                        writer.write(name, result)
+                        continue
+                    with open(os.path.join(args.output_dir, name), 'w',
+                              encoding='utf-8') as badge_fp:
+                        badge_fp.write(result)
+            finally:
+                if fp is not sys.stdin:
+                    fp.close()
+        if writer:
+            writer.close()
+    except (IOError, ValueError) as e:
+        if writer:
+            writer.close(prune=False)
+        sys.stderr.write('abadge: {}\n'.format(e))
+        return 1
+    finally:
+        if out and out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Measure how render_parallel scales with the number of worker processes.
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from abadge import Badge  # noqa: E402
+
+
+def parse_arguments():
+    p = ArgumentParser(
+        description='Benchmark render_parallel against render_many', )
+    p.add_argument('--rows',
+                   type=int,
+                   default=1000000,
+                   help='Number of badges to render', )
+    p.add_argument('--chunksize',
+                   type=int,
+                   default=5000,
+                   help='Rows per chunk sent to the workers', )
+    p.add_argument('--workers',
+                   type=int,
+                   nargs='+',
+                   default=[1, 2, 4, 8],
+                   help='Worker counts to measure', )
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    badge = Badge(thresholds={
+        'coverage': {'colors': {50: '#a00', 80: '#aa0', 100: '#0a0'},
+                     'shade': True},
+        'build': {'colors': {'passed': 'green', 'failed': 'red'}},
+    })
+    rows = [('coverage', i % 101) if i % 2 else
+            ('build', 'passed' if i % 3 else 'failed')
+            for i in range(args.rows)]
+
+    start = time.perf_counter()
+    expected = badge.render_many(rows)
+    base = time.perf_counter() - start
+    print('render_many: {:.2f} s'.format(base))
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        result = badge.render_parallel(rows, workers=workers,
+                                       chunksize=args.chunksize)
+        elapsed = time.perf_counter() - start
+        if result != expected:
+            print('Error: render_parallel gave a different result')
+            exit(1)
+        print('render_parallel, {} workers: {:.2f} s, speedup {:.2f}'
+              ''.format(workers, elapsed, base / elapsed))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the rendering hot paths.
+
+Run the benchmarks and save the result:
+
+    sbin/benchmark.py --output before.json
+
+Compare two saved runs, or a saved run with a new run, and exit with status 1
+if any benchmark got slower than the tolerance:
+
+    sbin/benchmark.py --compare before.json after.json
+    sbin/benchmark.py --compare before.json
+"""
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from abadge import Badge  # noqa: E402
+
+
+def numeric_thresholds(steps, shade=False):
+    colors = dict((i * 100 // steps, '#{:06x}'.format(i * 0x10101 % 0xffffff))
+                  for i in range(1, steps + 1))
+    return {'colors': colors, 'above': 'black', 'shade': shade}
+
+
+def setup_benchmarks():
+    """
+    Return a dict with the name and function of each benchmark.
+    """
+    badge = Badge()
+    strings = Badge(thresholds={'build': {
+        'colors': {'SUCCESS': 'green', 'FAILURE': 'red',
+                   'UNSTABLE': 'yellow', 'ABORTED': 'grey'}}})
+    numeric = dict((steps, Badge(thresholds={
+        'coverage': numeric_thresholds(steps)})) for steps in (5, 50, 500))
+    shading = Badge(thresholds={'coverage': numeric_thresholds(5, True)})
+
+    return {
+        'construct': lambda: Badge(),
+        'construct_kwargs': lambda: Badge(label='build', value='ok',
+                                          url='https://ci.example.com'),
+        'to_html': lambda: badge.to_html('build', 'passing'),
+        'to_html_url': lambda: badge.to_html(
+            'build', 'passing', url='https://ci.example.com/{label}'),
+        'thresholds_string': lambda: strings.to_html('build', 'UNSTABLE'),
+        'thresholds_5': lambda: numeric[5].to_html('coverage', 77),
+        'thresholds_50': lambda: numeric[50].to_html('coverage', 77),
+        'thresholds_500': lambda: numeric[500].to_html('coverage', 77),
+        'shading': lambda: shading.to_html('coverage', 77),
+        'make_badge': lambda: Badge.make_badge('build', 'passing'),
+    }
+
+
+def measure_memory(func, calls=1000):
+    """
+    Return the peak memory of one call and the memory retained per call.
+    """
+    func()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        base = tracemalloc.get_traced_memory()[0]
+        for _ in range(calls):
+            func()
+        retained = (tracemalloc.get_traced_memory()[0] - base) / calls
+    finally:
+        tracemalloc.stop()
+    return peak, retained
+
+
+def run(names, repeat):
+    benchmarks = setup_benchmarks()
+    results = {}
+    for name in names or sorted(benchmarks):
+        func = benchmarks[name]
+        timer = timeit.Timer(func, timer=time.perf_counter)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat, number)) / number
+        peak, retained = measure_memory(func)
+        results[name] = {'ops_per_sec': 1 / best,
+                         'usec_per_op': best * 1e6,
+                         'peak_bytes': peak,
+                         'retained_bytes': retained}
+        print('{:<20} {:>12,.0f} ops/s {:>9.2f} us {:>8} B peak {:>8.1f} B'
+              ' retained'.format(name, 1 / best, best * 1e6, peak, retained))
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def compare(before, after, tolerance):
+    """
+    Print the change of each benchmark, and return the names of the
+    benchmarks that are slower than the tolerance.
+    """
+    regressions = []
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old = before['results'][name]['ops_per_sec']
+        new = after['results'][name]['ops_per_sec']
+        change = (new - old) / old * 100
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<20} {:>12,.0f} -> {:>12,.0f} ops/s {:>+7.1f}%{}'
+              ''.format(name, old, new, change, flag))
+    return regressions
+
+
+def parse_arguments():
+    p = ArgumentParser(
+        description='Benchmark the rendering of badges', )
+    p.add_argument('benchmarks',
+                   nargs='*',
+                   help='Benchmarks to run, all if none are given', )
+    p.add_argument('--compare',
+                   nargs='+',
+                   metavar='FILE',
+                   help='Compare a saved run with another saved run, or with'
+                        ' a new run', )
+    p.add_argument('--output',
+                   help='Save the result as JSON in this file', )
+    p.add_argument('--repeat',
+                   type=int,
+                   default=5,
+                   help='Number of timing runs, the best is used', )
+    p.add_argument('--tolerance',
+                   type=float,
+                   default=10.0,
+                   help='Slowdown in percent reported as regression', )
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.compare and len(args.compare) > 2:
+        print('Error: --compare takes one or two files')
+        exit(2)
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as fp:
+            result = json.load(fp)
+    else:
+        result = run(args.benchmarks, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            baseline = json.load(fp)
+        if compare(baseline, result, args.tolerance):
+            exit(1)
@@ -19,6 +19,8 @@ setup(
     setup_requires=['setuptools', 'wheel'],
     tests_require=[],
     install_requires=[],
+    extras_require={'numpy': ['numpy']},
+    entry_points={'console_scripts': ['abadge = abadge:main']},
     data_files=[],
     options={},
 )
@@ -1,7 +1,23 @@
 """Test module for abadge."""
 
+import asyncio
+import copy
+import gc
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from abadge import Badge
+from http.client import HTTPConnection
+from xml.dom import minidom
+from abadge import Badge, BadgeSpec, TreeWriter, _BadgeServer, \
+    _import_numpy, disable_instrumentation, enable_instrumentation, main, \
+    write_tree
 
 
 class BadgeTester(unittest.TestCase):
@@ -35,6 +51,114 @@ class BadgeTester(unittest.TestCase):
                                                 value_text_color='white'),
             result)
 
+    def test_threads(self):
+        thresholds = {'cov*': {'colors': {50: '#a00', 80: '#aa0',
+                                          100: '#0a0'},
+                               'shade': True},
+                      'steps': {'colors': {0: 'red', 10: 'green'},
+                                'shade': True, 'shade_steps': 16},
+                      'build': {'colors': {'ok': 'green', 'fail': 'red'}}}
+        badges = [Badge(thresholds=thresholds),
+                  Badge(thresholds=thresholds, css_class='ab', escape=True),
+                  Badge(thresholds=thresholds)]
+        badges[2].enable_cache(maxsize=50)
+        rows = [('cov-{}'.format(i % 7), i % 101) for i in range(100)] + \
+               [('steps', i / 10.0) for i in range(100)] + \
+               [('build', 'ok'), ('build', 'fail'), ('<x>', 'y')]
+
+        def render(badge):
+            return ([badge.to_html(label, value) for label, value in rows],
+                    badge.render_many(rows, url='/{}'),
+                    [badge.to_svg(label, value) for label, value in rows[:20]],
+                    [Badge.make_badge(label, value) for label, value in
+                     rows[:20]])
+
+        # Fresh instances, so the threads compile the state concurrently
+        fresh = [Badge(**badge.config) for badge in badges]
+        expected = [render(badge) for badge in fresh]
+        results = []
+        barrier = threading.Barrier(32)
+
+        def worker(i):
+            barrier.wait()
+            for _ in range(3):
+                results.append((i % 3, render(badges[i % 3])))
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker, args=(i,))
+                       for i in range(32)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(96, len(results))
+        for i, result in results:
+            self.assertEqual(expected[i], result)
+        self.assertEqual(sorted(fresh[1].stylesheet().splitlines()),
+                         sorted(badges[1].stylesheet().splitlines()))
+
+    def test_import_time(self):
+        # The optional parts must not be imported until they are used. The
+        # import time depends on the machine, so it is only checked against
+        # a budget (milliseconds) when ABADGE_IMPORT_BUDGET is set.
+        budget = os.environ.get('ABADGE_IMPORT_BUDGET')
+        heavy = ['argparse', 'asyncio', 'concurrent', 'csv', 'fnmatch',
+                 'hashlib', 'json', 'numpy', 'tempfile', 'threading', 'urllib']
+        with tempfile.TemporaryDirectory() as tmp:
+            # Measure with the bytecode cached, like an installed module
+            env = dict(os.environ, PYTHONPYCACHEPREFIX=tmp)
+            env.pop('PYTHONDONTWRITEBYTECODE', None)
+            for _ in range(2):
+                result = subprocess.run(
+                    [sys.executable, '-X', 'importtime', '-c',
+                     'import abadge; abadge.Badge.make_badge("a", "b");'
+                     ' abadge.Badge(thresholds={"a*": {"colors": {1: "red"}}})'
+                     '.to_html("ab", 1)'],
+                    cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                    stderr=subprocess.PIPE, universal_newlines=True,
+                    check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative) / 1000.0
+        self.assertIn('abadge', times)
+        self.assertEqual([], [name for name in times
+                              if name.split('.')[0] in heavy])
+        if budget:
+            self.assertLess(times['abadge'], float(budget))
+
+    def test_shared_defaults(self):
+        badge = Badge()
+        badge.config['value_background'] = 'changed'
+        self.assertEqual('#888', Badge().config['value_background'])
+        self.assertEqual('#888', Badge.default_config['value_background'])
+        with self.assertRaises(TypeError):
+            Badge.default_config['value_background'] = 'changed'
+
+        class Subclass(Badge):
+            default_config = dict(Badge.default_config, extra='x')
+        self.assertEqual('x', Subclass().config['extra'])
+        self.assertEqual('y', Subclass(extra='y').config['extra'])
+        with self.assertRaises(TypeError):
+            Badge(extra='y')
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(Badge.make_badge('foo', 'bar')))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([self.default_config_template.format(
+            label='foo', value='bar', value_background='#888')] * 8, results)
+
     def test_override_config(self):
         config = {
             'border_radius': '6px',
@@ -95,6 +219,30 @@ class BadgeTester(unittest.TestCase):
             '</a>',
             badge.to_html())
 
+    def test_override_templates(self):
+        badge = Badge()
+        badge.override_templates_size = 2
+        expected = badge.to_html('a', 'b').replace('80%', '90%')
+        self.assertEqual(expected, badge.to_html('a', 'b', font_size='90%'))
+        templates = badge._override_templates[2]
+        self.assertEqual(1, len(templates))
+        self.assertEqual(expected, badge.to_html('c', 'd', font_size='90%')
+                         .replace('>c<', '>a<').replace('>d<', '>b<'))
+        self.assertEqual(1, len(templates))
+        for size in ('70%', '60%', '90%'):
+            badge.to_html('a', 'b', font_size=size)
+        self.assertEqual(2, len(templates))
+
+        # Unhashable overrides are compiled on every call
+        self.assertIn('font-family:x;', badge.to_html(
+            'a', 'b', font_family=['x']).replace("['x']", 'x'))
+
+        badge.config['font_size'] = '50%'
+        self.assertIn('font-size:90%', badge.to_html('a', 'b',
+                                                     font_size='90%'))
+        self.assertIn('font-size:50%', badge.to_html('a', 'b'))
+        self.assertIsNot(templates, badge._override_templates[2])
+
     def test_backgrounds(self):
         badge = Badge(value_backgrounds={'a': 'ac', 'b': 'bc', 'c': 'cc'})
         result = badge.to_html('foo', 'a')
@@ -275,6 +423,25 @@ class BadgeTester(unittest.TestCase):
                                                 value_background='#808080'),
             result)
 
+    def test_escape(self):
+        badge = Badge(escape=True)
+        self.assertEqual(self.default_config_template.format(
+            label='&lt;b&gt;&amp;', value='&quot;x&#x27;',
+            value_background='#888'), badge.to_html('<b>&', '"x\''))
+        self.assertEqual(self.default_config_template.format(
+            label='a', value='1.5', value_background='#888'),
+            badge.to_html('a', 1.5))
+        self.assertEqual(Badge().to_html('<b>', 'x'),
+                         badge.to_html('<b>', 'x', escape=False))
+        rows = [('<a>', 1), ('b', '<c>')]
+        self.assertEqual([badge.to_html(label, value, url='/x?a=1&b=2')
+                          for label, value in rows],
+                         badge.render_many(rows, url='/x?a=1&b=2'))
+        self.assertTrue(badge.to_html('a', 1, url='/x?a=1&b=2').startswith(
+            '<a href="/x?a=1&amp;b=2"'))
+        self.assertIn('>&lt;a&gt;</span>',
+                      Badge(css_class='ab').to_html('<a>', 1, escape=True))
+
     def test_link_target(self):
         badge = Badge.make_badge(url='foobar', link_target="_new")
         self.assertRegex(badge, '^<a href="foobar" target="_new" ')
@@ -282,3 +449,707 @@ class BadgeTester(unittest.TestCase):
         badge = Badge.make_badge(url='foobar', link_target="_blank")
         self.assertRegex(badge, '^<a href="foobar" target="_blank"'
                                 ' rel="noopener noreferer" ')
+
+    def test_many_thresholds(self):
+        colors = dict((i * 10, '#{:06x}'.format(i)) for i in range(50))
+        badge = Badge(thresholds={'foo': {'colors': colors, 'above': 'xc'}})
+        for value in [-5, 0, 1, 9, 10, 11, 245, 490, 491]:
+            expected = 'xc'
+            for threshold in sorted(colors):
+                if value <= threshold:
+                    expected = colors[threshold]
+                    break
+            self.assertEqual(
+                self.default_config_template.format(
+                    label='foo', value=value, value_background=expected),
+                badge.to_html('foo', value))
+
+        badge = Badge(thresholds={'foo': {'colors': {1.0: 'ac', 2.0: 'bc'},
+                                          'above': 'xc'}})
+        self.assertEqual(
+            self.default_config_template.format(
+                label='foo', value='nan', value_background='xc'),
+            badge.to_html('foo', 'nan'))
+
+        # Replacing the thresholds is picked up
+        badge.config['thresholds'] = {'foo': {'colors': {1.0: 'cc'}}}
+        self.assertEqual(
+            self.default_config_template.format(
+                label='foo', value='0.5', value_background='cc'),
+            badge.to_html('foo', 0.5))
+
+    def test_render_many(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'},
+                                          'above': 'xc'}},
+                      value_backgrounds={'u': 'uc'})
+        rows = [('foo', 0), ('foo', 2), ('foo', 4), ('bar', 'u'), ('b{}', 'v')]
+        self.assertEqual([badge.to_html(label, value)
+                          for label, value in rows],
+                         badge.render_many(rows))
+        self.assertEqual([badge.to_html(label, value, url='x{}',
+                                        link_target='_blank',
+                                        value_background='#123')
+                          for label, value in rows],
+                         list(badge.iter_html(iter(rows), url='x{}',
+                                              link_target='_blank',
+                                              value_background='#123')))
+        with self.assertRaises(TypeError):
+            badge.render_many(rows, noexistent_keyword_argument='fake')
+
+    def test_render_parallel(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'},
+                                          'above': 'xc'}})
+        rows = [('foo', i % 5) for i in range(50)] + [('bar', 'x')]
+        self.assertEqual(badge.render_many(rows, url='x{}'),
+                         badge.render_parallel(rows, workers=2, chunksize=7,
+                                               url='x{}'))
+        self.assertEqual(badge.render_many(rows),
+                         badge.render_parallel(iter(rows), workers=1))
+        self.assertEqual([], badge.render_parallel([], workers=2))
+        css_badge = Badge(css_class='ab')
+        html = css_badge.render_parallel([('foo', 1)], workers=2,
+                                         value_background='#123')
+        self.assertEqual(css_badge.render_many([('foo', 1)],
+                                               value_background='#123'), html)
+        self.assertIn('#123', css_badge.stylesheet())
+        with self.assertRaises(TypeError):
+            badge.render_parallel(rows, noexistent_keyword_argument='fake')
+
+    def test_iter_page(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'}}})
+        rows = [('foo', i % 5) for i in range(10)]
+        badges = badge.render_many(rows)
+        chunks = list(badge.iter_page(iter(rows), title='a<b',
+                                      buffer_size=1000))
+        self.assertEqual('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                         '<title>a&lt;b</title></head><body>\n'
+                         '<div style="display:flex;flex-wrap:wrap;gap:4px;">'
+                         '\n', chunks[0])
+        self.assertEqual(5, len(chunks))
+        self.assertEqual(''.join('<div>{}</div>\n'.format(html)
+                                 for html in badges),
+                         ''.join(chunks[1:])[:-len('</div>\n</body></html>'
+                                                   '\n')])
+        self.assertEqual(
+            '<table>\n<tr>' + '</tr>\n<tr>'.join(
+                ''.join('<td>{}</td>'.format(html) for html in badges[i:i + 4])
+                for i in range(0, 10, 4)) + '</tr>\n</table>\n',
+            ''.join(badge.iter_page(rows, layout='table', fragment=True)))
+        self.assertEqual('\n'.join(badges) + '\n',
+                         ''.join(badge.iter_page(rows, layout=None,
+                                                 fragment=True)))
+        self.assertIn('grid-template-columns:repeat(3,max-content);',
+                      ''.join(badge.iter_page(rows, columns=3)))
+
+        css_badge = Badge(css_class='ab',
+                          thresholds=badge.config['thresholds'])
+        output = io.StringIO()
+        css_badge.write_page(output, rows, fragment=True, buffer_size=1)
+        page = output.getvalue()
+        self.assertEqual(3, page.count('<style>'))
+        for rule in css_badge.stylesheet().splitlines():
+            self.assertEqual(1, page.count(rule))
+        with self.assertRaises(ValueError):
+            list(badge.iter_page(rows, layout='list'))
+
+    def test_thresholds_snapshot(self):
+        thresholds = {'foo': {'colors': {1: 'ac', 3: 'bc'}}}
+        badge = Badge(thresholds=thresholds)
+        thresholds['foo']['colors'][1] = 'changed'
+        self.assertEqual(
+            self.default_config_template.format(label='foo',
+                                                value='1',
+                                                value_background='ac'),
+            badge.to_html('foo', 1))
+        with self.assertRaises(TypeError):
+            badge.config['thresholds']['foo']['colors'][1] = 'changed'
+        with self.assertRaises(TypeError):
+            badge.config['value_backgrounds']['a'] = 'changed'
+
+        # Per-call options do not leak into the instance configuration
+        badge.to_html('bar', 'baz', value_background='#123', url='x')
+        self.assertEqual('#888', badge.config['value_background'])
+        self.assertEqual('', badge.config['url'])
+
+    def test_thresholds_interning(self):
+        thresholds = {'foo': {'colors': {1: 'ac', 3: 'bc'}},
+                      'bar': {'colors': {'a': 'ac'}}}
+        badge1 = Badge(thresholds=thresholds)
+        badge2 = Badge(thresholds=copy.deepcopy(thresholds))
+        self.assertIs(badge1.config['thresholds'],
+                      badge2.config['thresholds'])
+        self.assertIs(badge1._get_threshold(badge1.config['thresholds'],
+                                            'foo'),
+                      badge2._get_threshold(badge2.config['thresholds'],
+                                            'foo'))
+        # Equal, but different types are different tables
+        badge3 = Badge(thresholds={'foo': {'colors': {1.0: 'ac', 3: 'bc'}}})
+        self.assertIsNot(badge1.config['thresholds'],
+                         badge3.config['thresholds'])
+        self.assertEqual(badge1.to_html('foo', 2),
+                         badge3.to_html('foo', 2))
+        self.assertEqual(self.default_config_template.format(
+            label='foo', value='1.5', value_background='bc'),
+            badge3.to_html('foo', 1.5))
+
+        badge4 = pickle.loads(pickle.dumps(badge1))
+        self.assertIs(badge1.config['thresholds'],
+                      badge4.config['thresholds'])
+
+    def test_label_patterns(self):
+        thresholds = {'tests-*': {'colors': {1: 'ac'}, 'above': 'xc'},
+                      'tests-linux-*': {'colors': {1: 'bc'}, 'above': 'yc'},
+                      'tests-linux-arm': {'colors': {1: 'cc'}},
+                      '*-win??': {'colors': {1: 'dc'}},
+                      'cov[0-9]': {'colors': {1: 'ec'}},
+                      '*': {'colors': {1: 'fc'}},
+                      'docs': {'colors': {'ok': 'gc'}}}
+        badge = Badge(thresholds=thresholds)
+        for label, value_background in [('tests-linux-arm', 'cc'),
+                                        ('tests-linux-x86', 'bc'),
+                                        ('tests-linux-', 'bc'),
+                                        ('tests-win10', 'ac'),
+                                        ('build-win10', 'dc'),
+                                        ('cov7', 'ec'),
+                                        ('cov77', 'fc'),
+                                        ('docs', '#888')]:
+            for _ in range(2):
+                self.assertEqual(self.default_config_template.format(
+                    label=label, value=1, value_background=value_background),
+                    badge.to_html(label, 1))
+            self.assertEqual(badge.to_html(label, 1),
+                             Badge().to_html(label, 1, thresholds=thresholds))
+        self.assertEqual(['ac', 'xc'],
+                         badge.resolve_backgrounds('tests-mac', [1, 2]))
+        del thresholds['*']
+        self.assertEqual(self.default_config_template.format(
+            label='cov77', value=1, value_background='#888'),
+            Badge(thresholds=thresholds).to_html('cov77', 1))
+
+    def test_template_invalidation(self):
+        badge = Badge()
+        self.assertEqual(
+            self.default_config_template.format(label='foo',
+                                                value='bar',
+                                                value_background='#888'),
+            badge.to_html('foo', 'bar'))
+
+        badge.config['value_background'] = '#123'
+        self.assertEqual(
+            self.default_config_template.format(label='foo',
+                                                value='bar',
+                                                value_background='#123'),
+            badge.to_html('foo', 'bar'))
+
+        badge.config = dict(Badge.default_config, font_size='{90%}')
+        self.assertIn('font-size:{90%};', badge.to_html('foo', 'bar'))
+
+        badge.template = '{label}={value}'
+        self.assertEqual('foo=bar', badge.to_html('foo', 'bar'))
+
+    def test_css_class(self):
+        badge = Badge(css_class='badge',
+                      value_backgrounds={'a': '#0f0', 'b': '#f00'})
+        result = badge.render_many([('foo', 'a'), ('bar', 'b'),
+                                    ('baz', 'a')])
+        self.assertRegex(result[0], '^<span class="badge-[0-9a-f]{10}">foo'
+                                    '</span><span class="badge-[0-9a-f]{10}">'
+                                    'a</span>$')
+        self.assertEqual(result[0].split('"')[1], result[1].split('"')[1])
+        self.assertEqual(result[0].split('"')[3], result[2].split('"')[3])
+        self.assertNotEqual(result[0].split('"')[3], result[1].split('"')[3])
+
+        stylesheet = badge.stylesheet().splitlines()
+        self.assertEqual(3, len(stylesheet))
+        self.assertEqual(
+            '.{}{{background:#0f0;border-radius:0px 4px 4px 0px;color:white;'
+            'font-family:DejaVu Sans, Verdana, sans;font-size:80%;'
+            'padding:4px 8px 4px 8px;text-shadow:1px 1px black;}}'
+            ''.format(result[0].split('"')[3]),
+            stylesheet[1])
+
+        # Class names are the same for the same style in all instances
+        self.assertEqual(result[0], Badge(css_class='badge').to_html(
+            'foo', 'a', value_background='#0f0'))
+
+    def test_cache(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'}}})
+        badge.enable_cache(maxsize=2)
+        expected = badge.to_html('foo', 1)
+        self.assertEqual(expected, badge.to_html('foo', 1))
+        self.assertEqual(expected, badge.to_html(label='foo', value=1))
+        self.assertNotEqual(expected, badge.to_html('foo', 1.0))
+        self.assertEqual((2, 2, 0, 2, 2), badge.cache_info())
+
+        badge.to_html('foo', 3)
+        self.assertEqual((2, 3, 1, 2, 2), badge.cache_info())
+
+        # Unhashable arguments are rendered, but not cached
+        badge.to_html('foo', 1, thresholds={})
+        self.assertEqual((2, 3, 1, 2, 2), badge.cache_info())
+
+        # Changing the configuration invalidates the cache
+        badge.config['value_background'] = '#123'
+        badge.config['thresholds'] = {}
+        self.assertIn('background:#123;', badge.to_html('foo', 1))
+        self.assertEqual(1, badge.cache_info().currsize)
+
+        badge.cache_clear()
+        self.assertEqual((0, 0, 0, 2, 0), badge.cache_info())
+        with self.assertRaises(ValueError):
+            badge.enable_cache(maxsize=0)
+
+    def test_shading_colors(self):
+        badge = Badge(thresholds={'foo': {'colors': {0: 'red',
+                                                     10: '#00ff0080',
+                                                     20: '#00f'},
+                                          'shade': True},
+                                  'bar': {'colors': {0: '#000000',
+                                                     10: '#ffffff'},
+                                          'shade': True,
+                                          'shade_steps': 4}})
+        for value, color in [(0, '#ff0000'), (5, '#7f7f00bf'),
+                             (10, '#00ff0080'), (15, '#007f78bf'),
+                             (20, '#0000f0ff')]:
+            self.assertEqual(
+                self.default_config_template.format(label='foo',
+                                                    value=value,
+                                                    value_background=color),
+                badge.to_html('foo', value))
+
+        # Quantized to 4 steps
+        for value, color in [(0, '#000000'), (1, '#000000'), (2, '#3f3f3f'),
+                             (4, '#7f7f7f'), (6, '#7f7f7f'), (9, '#ffffff')]:
+            self.assertEqual(
+                self.default_config_template.format(label='bar',
+                                                    value=value,
+                                                    value_background=color),
+                badge.to_html('bar', value))
+
+        with self.assertRaises(ValueError):
+            Badge.make_badge('foo', 5, thresholds={
+                'foo': {'colors': {0: 'nocolor', 10: '#000'}, 'shade': True}})
+
+    def test_resolve_backgrounds(self):
+        badge = Badge(thresholds={'foo': {'colors': {0: '#f00',
+                                                     10: '#00ff0080',
+                                                     20: 'blue'},
+                                          'shade': True},
+                                  'bar': {'colors': {0.5: 'ac', 1.5: 'bc'},
+                                          'above': 'xc'},
+                                  'baz': {'colors': {'A': 'ac'}}},
+                      value_backgrounds={25: 'uc', 'B': 'bc'})
+        for label, values in [('foo', [-1, 0, 3, 10, 17, 20, 25, 30]),
+                              ('bar', [0, 0.5, 1.0, 1.5, 2, float('nan')]),
+                              ('baz', ['A', 'B', 'C']),
+                              ('boz', [25, 26])]:
+            expected = [self.default_config_template.format(
+                label=label, value=value, value_background=color)
+                for value, color in zip(values,
+                                        badge.resolve_backgrounds(label,
+                                                                  values))]
+            self.assertEqual(expected, badge.render_many(
+                (label, value) for value in values))
+
+    def test_sparkline(self):
+        badge = Badge(thresholds={'foo': {'colors': {0: '#f00',
+                                                     10: '#0f0',
+                                                     20: 'blue'},
+                                          'shade': True}},
+                      escape=True)
+        values = [-1, 0, 5, 20, 15, 10]
+        html = badge.to_sparkline('foo', values)
+        colors = badge.resolve_backgrounds('foo', values)
+        self.assertEqual(
+            ['width:2px;height:{}%;background:{};'.format(height, color)
+             for height, color in zip([5, 10, 32, 100, 77, 55], colors)],
+            [bar.split('"')[1] for bar in html.split('<span')[4:]])
+        self.assertIn('>foo</span>', html)
+        self.assertIn('&lt;b&gt;</span>', badge.to_sparkline('<b>', [1]))
+        self.assertIn('height:100%', badge.to_sparkline('foo', [3, 3]))
+        for bad in (float('nan'), float('inf'), float('-inf')):
+            html = badge.to_sparkline('bar', [1, bad, 2])
+            self.assertEqual(['5%', '0%', '100%'],
+                             [bar.split('height:')[1].split(';')[0]
+                              for bar in html.split('<span')[4:]])
+
+        svg = minidom.parseString(badge.to_sparkline('foo', values,
+                                                     format='svg'))
+        bars = svg.getElementsByTagName('rect')[-len(values):]
+        self.assertEqual(colors, [bar.getAttribute('fill') for bar in bars])
+        self.assertEqual(['foo'], [text.firstChild.data for text in
+                                   svg.getElementsByTagName('text')
+                                   if text.firstChild][-1:])
+
+    @unittest.skipUnless(_import_numpy(), 'numpy is not installed')
+    def test_resolve_backgrounds_numpy(self):
+        numpy = _import_numpy()
+        badge = Badge(thresholds={'foo': {'colors': {0: '#f00',
+                                                     50: '#00ff0080',
+                                                     100: 'blue'},
+                                          'shade': True,
+                                          'above': 'xc'},
+                                  'bar': {'colors': {0.0: '#000',
+                                                     1.0: '#fff'},
+                                          'shade': True,
+                                          'shade_steps': 8},
+                                  'baz': {'colors': dict(
+                                      (i, '#{:06x}'.format(i))
+                                      for i in range(0, 500, 7))}})
+        values = [i * 0.37 - 20 for i in range(1000)]
+        for label, caster in [('foo', int), ('bar', float), ('baz', int)]:
+            threshold = badge._get_threshold(badge.config['thresholds'],
+                                             label)
+            cast = [caster(value / 300.0 if caster is float else value)
+                    for value in values]
+            self.assertEqual(threshold.lookup_many(cast, None),
+                             threshold.lookup_many(cast, numpy))
+
+    def test_to_svg(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: '#e0c0a0',
+                                                     5: '#888'},
+                                          'shade': True}})
+        svg = badge.to_svg('foo', 3)
+        document = minidom.parseString(svg).documentElement
+        self.assertEqual('svg', document.tagName)
+        paths = document.getElementsByTagName('path')
+        self.assertEqual(['#444', '#b0a090'],
+                         [path.getAttribute('fill') for path in paths])
+        self.assertEqual(['foo', 'foo', '3', '3'],
+                         [text.firstChild.data for text
+                          in document.getElementsByTagName('text')])
+
+        wide = minidom.parseString(badge.to_svg('foo', 3333333))
+        self.assertGreater(float(wide.documentElement.getAttribute('width')),
+                           float(document.getAttribute('width')))
+
+        svg = badge.to_svg('<b>', 'a&b', url='x?a=1&b=2',
+                           link_target='_blank', label_text_shadow='none')
+        document = minidom.parseString(svg).documentElement
+        link = document.getElementsByTagName('a')[0]
+        self.assertEqual('x?a=1&b=2', link.getAttribute('xlink:href'))
+        self.assertEqual('_blank', link.getAttribute('target'))
+        self.assertEqual(['<b>', 'a&b', 'a&b'],
+                         [text.firstChild.data for text
+                          in document.getElementsByTagName('text')])
+
+        # Keywords and unknown units fall back to default sizes
+        self.assertEqual(badge.to_svg('foo', 3, font_size='13px'),
+                         badge.to_svg('foo', 3, font_size='small'))
+        self.assertEqual(badge.to_svg('foo', 3, font_size='16px',
+                                      padding='4.8px 0', border_radius=0),
+                         badge.to_svg('foo', 3, font_size='1vw',
+                                      padding='0.3em 1vw',
+                                      border_radius='1vw'))
+
+    def test_badge_spec(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'}}})
+        spec = BadgeSpec('foo', 2, url='x{}', link_target='_blank')
+        self.assertEqual(badge.to_html('foo', 2, url='x{}',
+                                       link_target='_blank'),
+                         badge.render_spec(spec))
+        self.assertEqual(badge.to_svg(**spec.to_kwargs()),
+                         badge.render_spec(spec, format='svg'))
+        self.assertEqual(spec, BadgeSpec('foo', 2, link_target='_blank',
+                                         url='x{}'))
+        self.assertEqual(hash(spec), hash(BadgeSpec('foo', 2, url='x{}',
+                                                    link_target='_blank')))
+        self.assertNotEqual(BadgeSpec('foo', 1), BadgeSpec('foo', True))
+        self.assertEqual(BadgeSpec('foo', 3, url='x{}', link_target='_blank'),
+                         spec.replace(value=3))
+        self.assertEqual(spec, pickle.loads(pickle.dumps(spec)))
+        with self.assertRaises(AttributeError):
+            spec.value = 3
+        with self.assertRaises(TypeError):
+            BadgeSpec('foo', 2, noexistent_keyword_argument='fake')
+        with self.assertRaises(TypeError):
+            BadgeSpec('foo', 2, label='bar')
+
+        badge.enable_cache()
+        self.assertEqual(badge.render_spec(spec), badge.render_spec(spec))
+        self.assertEqual((1, 1), badge.cache_info()[:2])
+        spec = BadgeSpec('foo', 2, thresholds={})
+        self.assertEqual(badge.to_html('foo', 2, thresholds={}),
+                         badge.render_spec(spec))
+
+    def test_instrumentation(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: '#000', 3: '#fff'},
+                                          'shade': True}})
+        calls = []
+        instrumentation = enable_instrumentation(
+            lambda phase, ns: calls.append(phase))
+        try:
+            self.assertEqual(badge.to_html('foo', 2),
+                             self.default_config_template.format(
+                                 label='foo', value=2,
+                                 value_background='#787878'))
+            badge.render_many([('foo', 1), ('bar', 1)])
+            badge.to_svg('foo', 1)
+        finally:
+            disable_instrumentation()
+        counters = instrumentation.snapshot()
+        self.assertEqual({'parse_args': 3, 'value_background': 4,
+                          'shade': 3, 'format': 4},
+                         dict((phase, counters[phase][0])
+                              for phase in counters))
+        self.assertTrue(all(ns >= 0 for _, ns in counters.values()))
+        self.assertEqual(14, len(calls))
+
+        badge.to_html('foo', 2)
+        self.assertEqual(counters, instrumentation.snapshot())
+        instrumentation.reset()
+        self.assertEqual((0, 0), instrumentation.snapshot()['shade'])
+
+        # Instrumentation of a single badge
+        parse_args = Badge.__dict__['_parse_args']
+        other = Badge()
+        instrumentation = badge.enable_instrumentation()
+        try:
+            badge.to_html('foo', 2)
+            other.to_html('foo', 2)
+            pickle.loads(pickle.dumps(badge)).to_html('foo', 2)
+            threads = [threading.Thread(target=enable_instrumentation)
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            disable_instrumentation()
+            self.assertIsNone(Badge.instrumentation)
+            other.to_html('foo', 2)
+        finally:
+            badge.disable_instrumentation()
+        self.assertEqual({'parse_args': 1, 'value_background': 1,
+                          'shade': 1, 'format': 1},
+                         dict((phase, calls) for phase, (calls, _)
+                              in instrumentation.snapshot().items()))
+        self.assertIs(parse_args, Badge.__dict__['_parse_args'])
+        self.assertIsNone(badge.instrumentation)
+
+    def test_config_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'badge.json')
+            with open(path, 'w') as fp:
+                json.dump({'thresholds': {'foo': {'colors': {'1': 'ac',
+                                                             '3': 'bc'}}},
+                           'url': 'x'}, fp)
+            badge = Badge.from_config_file(path, url='')
+            self.assertEqual(self.default_config_template.format(
+                label='foo', value=2, value_background='bc'),
+                badge.to_html('foo', 2))
+
+            toml = os.path.join(tmp, 'badge.toml')
+            with open(toml, 'w') as fp:
+                fp.write('font_size = "90%"\n'
+                         '[thresholds.foo.colors]\n1 = "ac"\n3 = "bc"\n')
+            self.assertEqual(badge.to_html('foo', 2).replace('80%', '90%'),
+                             Badge.from_config_file(toml).to_html('foo', 2))
+
+            # Renders which started before a reload use the old config
+            conf = badge._merge_config(('foo', 2), {})
+            with open(path, 'w') as fp:
+                json.dump({'thresholds': {'foo': {'colors': {'1': 'cc'},
+                                                  'above': 'dc'}},
+                           'font_size': '70%'}, fp)
+            badge.reload_config_file(path)
+            self.assertEqual(self.default_config_template.format(
+                label='foo', value=2, value_background='bc'),
+                badge._render_html(conf))
+            self.assertEqual(self.default_config_template.format(
+                label='foo', value=2, value_background='dc').replace(
+                    '80%', '70%'), badge.to_html('foo', 2))
+
+            badge.watch_config_file(path, interval=0.01)
+            try:
+                pickle.dumps(badge)
+                with open(path, 'w') as fp:
+                    fp.write('{"bogus": 1}')
+                with self.assertRaises(TypeError):
+                    badge.reload_config_file(path)
+                self.assertIn('70%', badge.to_html('foo', 2))
+                for _ in range(500):
+                    if badge.config_error is not None:
+                        break
+                    time.sleep(0.01)
+                self.assertIsInstance(badge.config_error, TypeError)
+                with open(path, 'w') as fp:
+                    json.dump({'value_background': 'ec'}, fp)
+                for _ in range(500):
+                    if badge.config['value_background'] == 'ec':
+                        break
+                    time.sleep(0.01)
+                self.assertEqual(self.default_config_template.format(
+                    label='bar', value=2, value_background='ec'),
+                    badge.to_html('bar', 2))
+                self.assertIsNone(badge.config_error)
+            finally:
+                badge.stop_watching()
+
+            # The watcher stops when the badge is collected, even if the
+            # file does not change
+            badge = Badge.from_config_file(path)
+            badge.watch_config_file(path, interval=60)
+            thread = badge._watcher.thread
+            del badge
+            gc.collect()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_write_tree(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'}}})
+        specs = [{'label': 'foo', 'value': 1}, {'label': 'bar', 'value': 2}]
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = write_tree(badge, specs, tmp)
+            self.assertEqual((2, 0, 0), (writer.written, writer.unchanged,
+                                         writer.removed))
+            with open(os.path.join(tmp, 'foo.html')) as fp:
+                self.assertEqual(badge.to_html('foo', 1), fp.read())
+            umask = os.umask(0)
+            os.umask(umask)
+            for name in ('foo.html', '.abadge-index.json'):
+                self.assertEqual(0o666 & ~umask, os.stat(
+                    os.path.join(tmp, name)).st_mode & 0o777)
+
+            writer = write_tree(badge, specs, tmp)
+            self.assertEqual((0, 2, 0), (writer.written, writer.unchanged,
+                                         writer.removed))
+
+            specs[0]['value'] = 3
+            writer = write_tree(badge, specs, tmp, fsync=False)
+            self.assertEqual((1, 1, 0), (writer.written, writer.unchanged,
+                                         writer.removed))
+            with open(os.path.join(tmp, 'foo.html')) as fp:
+                self.assertEqual(badge.to_html('foo', 3), fp.read())
+
+            writer = write_tree(badge, specs[:1] + [{'label': 'baz'}], tmp)
+            self.assertEqual((1, 1, 1), (writer.written, writer.unchanged,
+                                         writer.removed))
+            self.assertEqual(['.abadge-index.json', 'baz.html', 'foo.html'],
+                             sorted(os.listdir(tmp)))
+
+            # Nothing is removed when the rendering fails
+            with self.assertRaises(ValueError):
+                write_tree(badge, [{'label': 'foo', 'value': 'x'}], tmp)
+            self.assertEqual(['.abadge-index.json', 'baz.html', 'foo.html'],
+                             sorted(os.listdir(tmp)))
+
+        # Closing again, also in a with block, does nothing
+        with tempfile.TemporaryDirectory() as tmp:
+            with TreeWriter(tmp) as writer:
+                writer.write('a.html', 'x')
+                writer.write('b.html', 'y')
+                writer.close()
+            writer.close()
+            self.assertEqual((2, 0, 0), (writer.written, writer.unchanged,
+                                         writer.removed))
+            self.assertEqual(['.abadge-index.json', 'a.html', 'b.html'],
+                             sorted(os.listdir(tmp)))
+            with open(os.path.join(tmp, '.abadge-index.json')) as fp:
+                self.assertEqual(['a.html', 'b.html'], sorted(json.load(fp)))
+
+    def test_server(self):
+        badge = Badge(thresholds={'foo': {'colors': {1: 'ac', 3: 'bc'}}})
+        loop = asyncio.new_event_loop()
+        listener = loop.run_until_complete(
+            _BadgeServer(badge, cache_size=2).start('127.0.0.1', 0))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            conn = HTTPConnection('127.0.0.1',
+                                  listener.sockets[0].getsockname()[1])
+            conn.request('GET', '/badge/foo/2.html')
+            response = conn.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertEqual(self.default_config_template.format(
+                label='foo', value='2', value_background='bc'),
+                response.read().decode())
+            etag = response.getheader('ETag')
+
+            # Same connection, since it is kept alive
+            conn.request('GET', '/badge/foo/2.html?x=1',
+                         headers={'If-None-Match': etag})
+            response = conn.getresponse()
+            self.assertEqual(304, response.status)
+            self.assertEqual(b'', response.read())
+
+            conn.request('GET', '/badge/a%2Fb/x%20y.svg')
+            response = conn.getresponse()
+            self.assertEqual('image/svg+xml; charset=utf-8',
+                             response.getheader('Content-Type'))
+            self.assertIn('a/b', response.read().decode())
+            conn.request('GET',
+                         '/badge/%3Cscript%3Ealert(1)%3C%2Fscript%3E/x.html')
+            body = conn.getresponse().read().decode()
+            self.assertNotIn('<script>', body)
+            self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', body)
+            for path, status in (('/badge/foo/x.html', 400),
+                                 ('/badge/foo/1.png', 404),
+                                 ('/foo', 404)):
+                conn.request('GET', path)
+                response = conn.getresponse()
+                self.assertEqual(status, response.status)
+                response.read()
+            conn.request('POST', '/badge/foo/1.html', body='x')
+            response = conn.getresponse()
+            self.assertEqual(405, response.status)
+            response.read()
+
+            badge.config['thresholds'] = {'foo': {'colors': {1: 'cc'}}}
+            conn.request('GET', '/badge/foo/1.html',
+                         headers={'If-None-Match': etag})
+            response = conn.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertIn('background:cc', response.read().decode())
+            conn.close()
+        finally:
+            listener.close()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            # Let the connection handlers finish before closing the loop
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.close()
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, 'config.json')
+            records = os.path.join(tmp, 'records.jsonl')
+            output = os.path.join(tmp, 'badges.html')
+            with open(config, 'w') as fp:
+                json.dump({'thresholds': {'foo': {'colors': {'1': 'ac',
+                                                             '3': 'bc'}}}},
+                          fp)
+            with open(records, 'w') as fp:
+                fp.write('{"label": "foo", "value": 2}\n'
+                         '\n'
+                         '{"label": "bar", "value": "b",'
+                         ' "value_background": "cc"}\n')
+            self.assertEqual(0, main(['-c', config, '-o', output, records]))
+            with open(output) as fp:
+                self.assertEqual(
+                    [self.default_config_template.format(
+                        label='foo', value=2, value_background='bc'),
+                     self.default_config_template.format(
+                        label='bar', value='b', value_background='cc')],
+                    fp.read().splitlines())
+
+            records = os.path.join(tmp, 'records.csv')
+            with open(records, 'w') as fp:
+                fp.write('label,value\nfoo,1\nb/r,x\n')
+            badges = os.path.join(tmp, 'badges')
+            self.assertEqual(0, main(['-c', config, '-i', 'csv', '-f', 'svg',
+                                      '-d', badges, records]))
+            self.assertEqual(['b_r.svg', 'foo.svg'],
+                             sorted(os.listdir(badges)))
+            self.assertEqual(0, main(['-c', config, '-i', 'csv', '-u',
+                                      '-d', badges, records]))
+            self.assertEqual(['.abadge-index.json', 'b_r.html', 'b_r.svg',
+                              'foo.html', 'foo.svg'],
+                             sorted(os.listdir(badges)))
+
+            with open(records, 'w') as fp:
+                fp.write('label,value,bogus\nfoo,1,2\n')
+            self.assertEqual(1, main(['-i', 'csv', '-o', output, records]))